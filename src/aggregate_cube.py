@@ -0,0 +1,118 @@
+import os
+import numpy as np
+
+
+class Aggregate_Cube():
+    '''
+    Number of messages, words and characters per participant, calendar day
+    and hour of the day. Only the cells with at least one message are
+    stored (as sorted coordinate lists), so the cube of a chat is never
+    bigger than the chat itself. Everything which only depends on these
+    counts, like messages per day or per weekday and hour, is a reduction
+    of the cube with a single bincount.
+
+    Args of __init__:
+    - names: Names of the participants, the participant coordinates are
+        positions in this list
+    - first_day: datetime64[D] of the first day, day coordinates count
+        the days since then
+    - n_days: Number of days from the first to the last message
+    - n_messages: Number of messages the cube was built from
+    - cells: dict with the coordinate arrays "participant", "day" and
+        "hour" and the counts "messages", "words" and "chars" of the cells
+    '''
+
+    measures = ['messages', 'words', 'chars']
+
+    def __init__(self, names, first_day, n_days, n_messages, cells):
+        self.names = list(names)
+        self.first_day = np.datetime64(first_day, 'D')
+        self.n_days = int(n_days)
+        self.n_messages = int(n_messages)
+        self.cells = cells
+
+
+    @classmethod
+    def build(cls, names, codes, timestamps, words, chars):
+        '''
+        Args:
+        - names: Names of the participants
+        - codes: Position in names of the writer of every message
+        - timestamps: datetime64 array of the messages
+        - words, chars: Number of words and characters of every message
+        '''
+        seconds = timestamps.astype('datetime64[s]').astype('int64')
+        days = timestamps.astype('datetime64[D]')
+        first_day = days.min() if len(days) > 0 else np.datetime64(0, 'D')
+        day_index = (days - first_day).astype('int64')
+        n_days = day_index.max() + 1 if len(days) > 0 else 1
+        hour = (seconds // 3600) % 24
+
+        key = (codes.astype('int64') * n_days + day_index) * 24 + hour
+        keys, inverse = np.unique(key, return_inverse=True)
+        cells = {
+            'participant': (keys // (24 * n_days)).astype('int32'),
+            'day': (keys // 24 % n_days).astype('int32'),
+            'hour': (keys % 24).astype('int8')}
+        for measure, values in [('messages', None), ('words', words),
+                                ('chars', chars)]:
+            cells[measure] = np.bincount(inverse, weights=values,
+                                         minlength=len(keys)).astype('int64')
+        return cls(names, first_day, n_days, len(codes), cells)
+
+
+    @property
+    def days(self):
+        return self.first_day + np.arange(self.n_days)
+
+
+    def reduce(self, measure='messages', by=('participant', 'day')):
+        '''
+        Sums a measure over all axes which are not in by.
+
+        Args:
+        - measure: "messages", "words" or "chars"
+        - by: The axes which are kept, in this order. Possible axes are
+            "participant", "day", "hour" and "weekday" (monday is 0).
+
+        Returns: Dense int64 array with one dimension per axis in by
+        '''
+        # 1970-01-01 was a thursday, which is weekday 3 when monday is 0
+        first_weekday = (self.first_day.astype('int64') + 3) % 7
+        axes = {
+            'participant': (self.cells['participant'], len(self.names)),
+            'day': (self.cells['day'], self.n_days),
+            'hour': (self.cells['hour'], 24),
+            'weekday': ((self.cells['day'] + first_weekday) % 7, 7)}
+        key = np.zeros(len(self.cells['day']), dtype='int64')
+        shape = list()
+        for axis in by:
+            coordinates, size = axes[axis]
+            key = key * size + coordinates
+            shape.append(size)
+        sums = np.bincount(key, weights=self.cells[measure],
+                           minlength=int(np.prod(shape)))
+        return sums.astype('int64').reshape(shape)
+
+
+    def save(self, path):
+        np.savez_compressed(path, names=np.array(self.names, dtype=str),
+                            first_day=self.first_day, n_days=self.n_days,
+                            n_messages=self.n_messages, **self.cells)
+
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            cells = {key: arrays[key] for key in
+                     ['participant', 'day', 'hour'] + cls.measures}
+            return cls(arrays['names'].tolist(), arrays['first_day'],
+                       arrays['n_days'], arrays['n_messages'], cells)
+
+
+    @staticmethod
+    def path_for(chat_path):
+        '''
+        Where the cube of the chat at chat_path is saved.
+        '''
+        return os.path.splitext(chat_path)[0] + '.cube.npz'
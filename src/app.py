@@ -3,10 +3,17 @@ import dash
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from plotly.offline import plot
-from config import background_col
-from whatsapp_analytics import Whatsapp_Analytics
+from config import background_col, upload_idle_seconds
+from chat_loader import Chat_Loader, Chunked_Upload, upload_prefix
+from wordcloud_service import Wordcloud_Service
 import os
+import re
+import json
+import gzip
+import hashlib
+import weakref
 
 # MAIN CONFIGURATION
 ##################################################################
@@ -15,6 +22,7 @@ server = flask.Flask(__name__)
 app = dash.Dash(__name__, server=server)
 app.css.append_css({'external_url': '/static/style.css'})
 app.css.append_css({"external_url": "https://codepen.io/chriddyp/pen/bWLwgP.css"})
+app.scripts.append_script({'external_url': '/static/chunked_upload.js'})
 app.server.static_folder = 'static'  
 
 
@@ -26,17 +34,123 @@ app.server.static_folder = 'static'
 # executed in the background when selecting one of them:
 plot_method_translations = {
             'Chronology': 'plot_chronology(nb_mode=True)',
+            'Weekly Moving Average': 'plot_rolling_average(nb_mode=True, window=7)',
+            'Monthly Moving Average': \
+                'plot_rolling_average(nb_mode=True, window=30)',
+            'Share Over Time': 'plot_share_over_time(nb_mode=True)',
+            'Cumulative Messages': 'plot_cumulative_messages(nb_mode=True)',
             'Message Size Distr.': 'plot_dist_of_message_size(nb_mode=True)',
             'Daily Active Time': 'plot_intraday_active_time(nb_mode=True)',
             'Distr. Over Weekdays': 'plot_dist_of_weekdays(nb_mode=True)', 
+            'Weekday x Hour Heatmap': 'plot_weekday_hour_heatmap(nb_mode=True)',
             'Most Used Emojis': 'plot_most_used_emojis(nb_mode=True)',
+            'Wordcloud': 'plot_wordcloud(nb_mode=True)',
             'Overall Participition': 'plot_overall_participition(nb_mode=True)',
             'Distr. of Long Respondtimes': \
                 'plot_dist_of_respondtimes(nb_mode=True, tail=True)',
             'Distr. of Short Respondtimes': \
                 'plot_dist_of_respondtimes(nb_mode=True, tail=False)',
+            'Conversation Starters': 'plot_session_starters(nb_mode=True)',
+            'Conversation Lengths': 'plot_dist_of_session_length(nb_mode=True)',
+            'Who Replies To Whom': 'plot_interaction_heatmap(nb_mode=True)',
+            'Reply Times Between Persons': \
+                'plot_interaction_heatmap(nb_mode=True, median_time=True)',
+            'Overview': 'calc_overview()',
 }
 
+# Plots over time or over conversations can't be drawn from the evenly spaced
+# chunks of a preview (see Whatsapp_Analytics.read_sample), they are only 
+# shown once the whole chat is parsed
+full_chat_plots = ['Chronology', 'Weekly Moving Average', 
+                   'Monthly Moving Average', 'Share Over Time',
+                   'Cumulative Messages', 'Conversation Starters',
+                   'Conversation Lengths']
+
+# Number of messages which are listed below the search box
+max_search_results = 50
+
+# Loads every chat only once, also when several callbacks or users request
+# it at the same time. Big chats are shown as a preview until fully parsed.
+loader = Chat_Loader()
+
+# Renders the wordclouds of loaded chats in the background and caches them as
+# png files, which are served by the /wordcloud/ route
+wordclouds = Wordcloud_Service()
+
+
+def get_analytics(path, languages):
+    wa = loader.get(path, languages)
+    wordclouds.prerender(wa)
+    return wa
+
+
+def loading_status(path, languages):
+    status = ''
+    fraction = loader.preview_fraction_of(path, languages)
+    if fraction is not None:
+        percent = round(100 * fraction, 1)
+        status = ('Preview based on ' + str(percent) + '% of the chat. '
+                  'Exact results are being computed ...')
+    if path is not None and wordclouds.is_rendering(path):
+        status += ' Wordclouds are being rendered ...'
+    return status.strip()
+
+
+def note_figure(text=None):
+    '''
+    An empty figure, with text in its center if given.
+    '''
+    layout = {
+        'paper_bgcolor': background_col,
+        'plot_bgcolor': background_col,
+        'height': 700,
+        'xaxis': {'visible': False},
+        'yaxis': {'visible': False},
+    }
+    if text is not None:
+        layout['annotations'] = [{
+            'text': text,
+            'showarrow': False,
+            'font': {'color': 'white', 'size': 20},
+        }]
+    return {'data': [], 'layout': layout}
+
+
+def wordcloud_figure(wa):
+    '''
+    A figure showing the cached wordcloud of the chat as image, or a note
+    while it is still being rendered or if it can't be rendered.
+    '''
+    try:
+        path = wordclouds.get(wa)
+    except ValueError as error:
+        # For example a chat without any words
+        return note_figure('No wordcloud: ' + str(error))
+    if path is None:
+        return note_figure('The wordcloud is being rendered ...')
+    figure = note_figure()
+    figure['layout']['images'] = [{
+        'source': '/wordcloud/' + os.path.basename(path),
+        'xref': 'paper', 'yref': 'paper', 'x': 0.5, 'y': 0.5,
+        'sizex': 1, 'sizey': 1, 'xanchor': 'center', 
+        'yanchor': 'middle', 'layer': 'below',
+    }]
+    return figure
+
+
+def zoom_range(relayout):
+    '''
+    Extracts the visible x range of a relayoutData dict of a dcc.Graph. 
+    Returns None when the plot was reset to the full range.
+    '''
+    if relayout is None or 'xaxis.autorange' in relayout:
+        return None
+    if 'xaxis.range[0]' in relayout:
+        return relayout['xaxis.range[0]'], relayout['xaxis.range[1]']
+    if 'xaxis.range' in relayout:
+        return tuple(relayout['xaxis.range'])
+    return None
+
 
 # STYLES STUFF
 ##################################################################
@@ -112,6 +226,27 @@ app.layout = html.Div(
                         ),
                     ]
                 ),
+                html.Div(
+                    className='row',
+                    style={'height': inner_group_margin},
+                ),
+                html.Div(
+                    className='row',
+                    children=[
+                        html.Div(
+                            style={
+                                **path_style,
+                                **{'font-size': '16px'}
+                            },
+                            children=[
+                                'or upload a chat file: ',
+                                # The file input is added and handled by 
+                                # static/chunked_upload.js
+                                html.Span(id='uploadfile-container'),
+                            ]
+                        ),
+                    ]
+                ),
                 html.Div(
                     className='row', 
                     style={'height': between_group_margin}
@@ -220,6 +355,80 @@ app.layout = html.Div(
                             ]
                         ),
                     ]
+                ),
+                html.Div(
+                    className='row',
+                    style={
+                        'height': '60px',
+                    },
+                ),
+                html.Div(
+                    className='row',
+                    children=[
+                        html.Div(
+                            style={
+                                **path_style,
+                                **{'margin-left': '0px'}
+                            },
+                            children=[
+                                'Search Messages'
+                            ]
+                        ),
+                    ]
+                ),
+                html.Div(
+                    className='row',
+                    style={'height': inner_group_margin},
+                ),
+                html.Div(
+                    className='row',
+                    children=[
+                        html.Div(
+                            style=path_style,
+                            children=[
+                                dcc.Input(
+                                    id='searchterm',
+                                    type='text',
+                                    placeholder='Words or "a phrase"...'
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+                html.Div(
+                    className='row',
+                    style={'height': inner_group_margin},
+                ),
+                html.Div(
+                    className='row',
+                    children=[
+                        html.Div(
+                            className='button button-primary',
+                            children=[
+                                html.Button(
+                                    'Search!', 
+                                    id='search',
+                                    style={
+                                        'border-width': '0px', 
+                                        'font-size': '16px',
+                                    }
+                                ),
+                            ]
+                        )
+                    ]
+                ),
+                html.Div(
+                    className='row',
+                    style={'height': inner_group_margin},
+                ),
+                html.Div(
+                    id='searchresults',
+                    style={
+                        **path_style,
+                        **{'font-size': '14px', 'width': '350px',
+                           'max-height': '400px', 'overflow-y': 'auto'}
+                    },
+                    children=[]
                 )
             ]
         ),
@@ -231,6 +440,36 @@ app.layout = html.Div(
                     style={'height': upper_right_margin}
                 ),
                 html.Div(
+                    id='status',
+                    style={
+                        **path_style,
+                        **{'font-size': '16px'}
+                    },
+                    children=''
+                ),
+                # Estimated totals while only a preview is shown
+                html.Div(
+                    id='estimates',
+                    style={
+                        **path_style,
+                        **{'font-size': '14px'}
+                    },
+                    children=[]
+                ),
+                dcc.Interval(
+                    id='refresh',
+                    interval=1000,
+                    n_intervals=0,
+                    disabled=True
+                ),
+                # 'preview' or 'full', see update_phase
+                html.Div(
+                    id='phase',
+                    style={'display': 'none'},
+                    children=''
+                ),
+                html.Div(
+                    id='showplot-container',
                     style = {
                         'height': '700px',
                     },
@@ -246,6 +485,11 @@ app.layout = html.Div(
                             }
                         )
                     ]
+                ),
+                # All plots at once, filled when "Overview" is chosen
+                html.Div(
+                    id='overview',
+                    children=[]
                 )
             ]
             
@@ -256,45 +500,313 @@ app.layout = html.Div(
 # CALLBACKS
 ##################################################################
 
-@app.callback(Output('chooseplot', 'options'),
+@app.callback([Output('chooseplot', 'options'),
+               Output('chooseplot', 'value')],
               [Input('upload', 'n_clicks')],
               [State('path', 'value')])
 def update_dropdown(n_clicks, path):
-    if os.path.exists(str(path)):
-        wa = Whatsapp_Analytics(path)
-        for_dropdown = list()
-        for key in plot_method_translations.keys():
-            for_dropdown.append({'label': key, 'value': key})
-        return for_dropdown
+    if not loader.exists(path):
+        raise PreventUpdate()
+    for_dropdown = list()
+    for key in plot_method_translations.keys():
+        for_dropdown.append({'label': key, 'value': key})
+    return for_dropdown, for_dropdown[0]['value']
 
 
-@app.callback(Output('chooseplot', 'value'),
-              [Input('upload', 'n_clicks')],
-              [State('path', 'value')])
-def update_dropdown(n_clicks, path):
-    if os.path.exists(str(path)):
-        wa = Whatsapp_Analytics(path)
-        for_dropdown = list()
-        for key in plot_method_translations.keys():
-            for_dropdown.append({'label': key, 'value': key})
-        return for_dropdown[0]
+@app.callback(Output('status', 'children'),
+              [Input('refresh', 'n_intervals'),
+               Input('upload', 'n_clicks')],
+              [State('path', 'value'),
+               State('chooselanguage', 'value'),
+               State('status', 'children')])
+def update_status(n_intervals, n_clicks, path, languages, current):
+    status = loading_status(path, languages)
+    if status == current:
+        raise PreventUpdate()
+    return status
+
+
+@app.callback(Output('refresh', 'disabled'),
+              [Input('refresh', 'n_intervals'),
+               Input('upload', 'n_clicks')],
+              [State('path', 'value'),
+               State('chooselanguage', 'value')])
+def toggle_refresh(n_intervals, n_clicks, path, languages):
+    # Polls only while the preview or a wordcloud of the chat is pending
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'upload.n_clicks' in triggered:
+        return False
+    if not loader.exists(path):
+        return True
+    return (not loading_status(path, languages) 
+            and not loader.is_loading(path, languages))
+
 
+@app.callback(Output('phase', 'children'),
+              [Input('status', 'children')],
+              [State('path', 'value'),
+               State('chooselanguage', 'value'),
+               State('phase', 'children')])
+def update_phase(status, path, languages, current):
+    # Whether a preview or the whole chat is shown, changes only once per
+    # chat, so the plots aren't redrawn on every change of the status
+    if not loader.exists(path):
+        raise PreventUpdate()
+    phase = 'full'
+    if loader.preview_fraction_of(path, languages) is not None:
+        phase = 'preview'
+    if phase == current:
+        raise PreventUpdate()
+    return phase
 
 
 @app.callback(Output('showplot', 'figure'),
              [Input('upload', 'n_clicks'),
-              Input('chooseplot', 'value')],
+              Input('chooseplot', 'value'),
+              Input('showplot', 'relayoutData'),
+              Input('phase', 'children'),
+              Input('status', 'children')],
              [State('path', 'value'),
               State('chooselanguage', 'value')])
-def upload_chat(n_clicks, what, path, languages):
+def upload_chat(n_clicks, what, relayout, phase, status, path, languages):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if triggered == ['showplot.relayoutData'] and what != 'Chronology':
+        # Only the chronology depends on the zoom, redrawing any other plot
+        # would undo the zoom of the user
+        raise PreventUpdate()
+    if triggered == ['status.children'] and what != 'Wordcloud':
+        # Only the wordcloud is shown once it is rendered, any other plot
+        # is redrawn once the whole chat is parsed, see update_phase
+        raise PreventUpdate()
     if path is not None:
-        wa = Whatsapp_Analytics(path, languages=languages)
+        wa = get_analytics(path, languages)
+        if what in full_chat_plots and wa.sample_fraction < 1:
+            return note_figure('Available once the whole chat is parsed')
+        if what == 'Chronology':
+            # Re-aggregate only the zoomed window of the chronology
+            return wa.plot_chronology(nb_mode=True, 
+                                      x_range=zoom_range(relayout))
+        if what == 'Overview':
+            # Shown by show_overview instead
+            raise PreventUpdate()
+        if what == 'Wordcloud':
+            # Rendered in the background and shown as image, see 
+            # wordcloud_figure
+            return wordcloud_figure(wa)
         method = 'wa.' + plot_method_translations[what]
         fig = eval(method)
         return fig
 
 
 
+@app.callback(Output('estimates', 'children'),
+              [Input('upload', 'n_clicks'),
+               Input('phase', 'children')],
+              [State('path', 'value'),
+               State('chooselanguage', 'value')])
+def show_estimates(n_clicks, phase, path, languages):
+    if path is None or loader.preview_fraction_of(path, languages) is None:
+        return []
+    wa = get_analytics(path, languages)
+    if wa.sample_fraction == 1:
+        return []
+    estimates = wa.calc_preview_estimates()
+    column = 'Number messages sent'
+    estimates = estimates.sort_values(column, ascending=False)
+    rows = [html.Tr([html.Th('Estimated messages'), html.Th('')])]
+    for name, row in estimates.iloc[:wa.top_n].iterrows():
+        rows.append(html.Tr([
+            html.Td(name), 
+            html.Td('{:,.0f} \u00b1 {:,.0f}'.format(
+                row[column], row[column + ' (95% error bound)']))]))
+    return [html.Table(rows)]
+
+
+@app.callback([Output('overview', 'children'),
+               Output('showplot-container', 'style')],
+              [Input('chooseplot', 'value'),
+               Input('upload', 'n_clicks'),
+               Input('phase', 'children')],
+              [State('path', 'value'),
+               State('chooselanguage', 'value')])
+def show_overview(what, n_clicks, phase, path, languages):
+    if what != 'Overview' or path is None:
+        return [], {'height': '700px'}
+    wa = get_analytics(path, languages)
+    plots = None
+    if wa.sample_fraction < 1:
+        full_chat_methods = [plot_method_translations[p].split('(')[0]
+                             for p in full_chat_plots]
+        plots = [(method, kwargs) for method, kwargs in wa.overview_plots()
+                 if method not in full_chat_methods]
+    # The plots are computed concurrently, see calc_overview
+    graphs = list()
+    for traces, layout in wa.calc_overview(plots):
+        graphs.append(dcc.Graph(figure={'data': traces, 'layout': layout},
+                                style={'height': '700px'}))
+    return graphs, {'display': 'none'}
+
+
+@app.callback(Output('searchresults', 'children'),
+              [Input('search', 'n_clicks')],
+              [State('path', 'value'),
+               State('chooselanguage', 'value'),
+               State('searchterm', 'value')])
+def search_messages(n_clicks, path, languages, query):
+    if path is None or not query:
+        return []
+    wa = get_analytics(path, languages)
+    # A query in double quotes is searched as a phrase
+    phrase = len(query) > 1 and query.startswith('"') and query.endswith('"')
+    try:
+        found = wa.search(query.strip('"'), phrase=phrase)
+    except ValueError as error:
+        # The chat was loaded without its message texts
+        return [html.P(str(error))]
+    results = [html.P(str(len(found)) + ' messages found')]
+    for stamp, who, message in found[['Timestamp', 'Written_by', 
+                                      'Message']].values[:max_search_results]:
+        results.append(html.P(str(stamp) + ' ' + who + ': ' + message))
+    return results
+
+
+
+# CHUNKED UPLOAD ENDPOINT
+##################################################################
+
+# The browser sends a chat file in chunks (see static/chunked_upload.js) 
+# which are parsed while the upload is still running. The parsed chat is 
+# stored in the loader and can then be used like a path. Uploads without a
+# new chunk for upload_idle_seconds are aborted.
+uploads = {}
+
+
+def expire_uploads():
+    for upload_id, upload in list(uploads.items()):
+        if upload.idle_seconds() > upload_idle_seconds:
+            uploads.pop(upload_id, None)
+            upload.abort()
+
+
+@server.route('/upload/<upload_id>/chunk', methods=['POST'])
+def upload_chunk(upload_id):
+    if not re.match(r'^[A-Za-z0-9_-]{1,64}$', upload_id):
+        flask.abort(400)
+    expire_uploads()
+    if upload_id not in uploads:
+        uploads[upload_id] = Chunked_Upload(loader, upload_prefix + upload_id)
+    upload = uploads[upload_id]
+    try:
+        for block in iter(lambda: flask.request.stream.read(64 * 1024), b''):
+            upload.feed(block)
+    except Exception as error:
+        uploads.pop(upload_id, None)
+        return flask.jsonify({'error': str(error)}), 400
+    return flask.jsonify({'received': True})
+
+
+@server.route('/upload/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    expire_uploads()
+    upload = uploads.pop(upload_id, None)
+    if upload is None:
+        flask.abort(404)
+    try:
+        upload.finish()
+    except Exception as error:
+        return flask.jsonify({'error': str(error)}), 400
+    return flask.jsonify({'path': upload.name})
+
+
+
+@server.route('/wordcloud/<name>')
+def send_wordcloud(name):
+    if not re.match(r'^[0-9a-f]{40}\.png$', name):
+        flask.abort(404)
+    return flask.send_from_directory(wordclouds.directory, name,
+                                     mimetype='image/png')
+
+
+
+# JSON API
+##################################################################
+
+# The numbers behind the plots (see Whatsapp_Analytics.calc_aggregates) as 
+# JSON, for example /api/aggregates/daily?path=/path/to/chat.txt
+# The encoded responses are kept as long as the chat is loaded. Every response
+# has the hash of its content as ETag, so clients which send it back in 
+# If-None-Match get a 304 without any body.
+api_kinds = ['summary', 'daily', 'hours', 'weekdays', 'emojis', 
+             'respond_times']
+api_responses = weakref.WeakKeyDictionary()
+
+
+def encode_aggregates(wa, kind):
+    '''
+    The ETag, JSON and gzipped JSON of the aggregates of a chat. Every kind
+    is computed and compressed only once per loaded chat.
+    '''
+    encoded = api_responses.setdefault(wa, {})
+    if kind not in encoded:
+        if kind == 'all':
+            data = {k: wa.calc_aggregates(k) for k in api_kinds}
+        else:
+            data = wa.calc_aggregates(kind)
+        body = json.dumps(data, separators=(',', ':'), 
+                          ensure_ascii=False).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        encoded[kind] = (etag, body, gzip.compress(body))
+    return encoded[kind]
+
+
+@server.route('/api/aggregates', defaults={'kind': 'all'})
+@server.route('/api/aggregates/<kind>')
+def send_aggregates(kind):
+    path = flask.request.args.get('path')
+    languages = flask.request.args.get('languages', 'German').split(',')
+    if kind not in api_kinds + ['all']:
+        flask.abort(404)
+    if not loader.exists(path):
+        return flask.jsonify({'error': 'Unknown chat ' + str(path)}), 404
+    try:
+        wa = loader.get(path, languages)
+    except ValueError as error:
+        # The file is not a chat of a known format
+        return flask.jsonify({'error': str(error)}), 400
+    etag, body, compressed = encode_aggregates(wa, kind)
+    
+    # Every content coding needs its own ETag, otherwise a cache could 
+    # revalidate the gzipped response and serve it as the plain one
+    gzipped = 'gzip' in flask.request.accept_encodings
+    if gzipped:
+        etag += '-gzip'
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    elif gzipped:
+        response = flask.Response(compressed, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Clients may keep the response but have to revalidate it every time, 
+    # since a preview of a chat is replaced by the exact numbers later
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# Bytes held by every loaded chat and the memory budget of the loader (see 
+# Chat_Loader.memory_usage), for monitoring memory capped deployments
+@server.route('/api/memory')
+def send_memory_usage():
+    usage = loader.memory_usage()
+    return flask.jsonify({
+        'budget': loader.memory_budget,
+        'total': int(usage['Total'].sum()),
+        'chats': json.loads(usage.to_json(orient='records'))})
+
+
+
 # MAIN LOOP
 ##################################################################
 if __name__ == '__main__':#
@@ -0,0 +1,152 @@
+import re
+from collections import Counter, OrderedDict
+import pandas as pd
+from config import format_sample_lines
+
+
+class Chat_Format():
+    '''
+    One format of exported whatsapp chats. Every message line of such a chat
+    starts with a prefix which consists of a timestamp, either in brackets
+    ("[timestamp] Name: message") or followed by a dash
+    ("timestamp - Name: message").
+
+    Args of __init__:
+    - name: Name of the format, stored as .format of Whatsapp_Analytics
+    - timestamp: Regex of the timestamp. It must not contain groups.
+    - timestamp_format: Format of the timestamp as understood by
+        pd.to_datetime. The quirks of the format (12 hour clock with AM/PM,
+        4 digit years, day before month) are derived from it.
+    - bracketed: Whether the timestamp is in brackets or followed by a dash
+    '''
+
+    def __init__(self, name, timestamp, timestamp_format, bracketed=False):
+        self.name = name
+        self.timestamp = timestamp
+        self.timestamp_format = timestamp_format
+        self.bracketed = bracketed
+        self.twelve_hour = '%p' in timestamp_format
+        self.four_digit_year = '%Y' in timestamp_format
+        self.day_first = timestamp_format.index('%d') < \
+            timestamp_format.index('%m')
+        if bracketed:
+            self.line_pattern = r'\[' + timestamp + r'\] '
+        else:
+            self.line_pattern = timestamp + ' - '
+        self.prefix = re.compile(self.line_pattern.replace(
+            timestamp, '(?P<timestamp>' + timestamp + ')', 1))
+
+
+    def decode(self, timestamps, errors='raise'):
+        '''
+        Converts a list of timestamp strings into a DatetimeIndex.
+        '''
+        timestamps = pd.Series(timestamps, dtype=object)
+        if self.twelve_hour:
+            # Newer exports put a narrow no-break space before AM/PM
+            timestamps = timestamps.str.replace('\u202f', ' ')
+        return pd.DatetimeIndex(pd.to_datetime(
+            timestamps, format=self.timestamp_format, errors=errors))
+
+
+# All known formats. Formats which can't be told apart by their prefix (like
+# day/month and month/day order) are decided by which one decodes all
+# timestamps of the sample, the first registered one wins a tie. Since the 
+# sample can be ambiguous, decode_timestamps falls back to the other formats 
+# with the same prefix when a later timestamp doesn't fit.
+chat_formats = OrderedDict()
+
+
+def register_format(chat_format):
+    chat_formats[chat_format.name] = chat_format
+    return chat_format
+
+
+register_format(Chat_Format(
+    'iphone', r'\d\d\.\d\d\.\d\d, \d\d:\d\d:\d\d', '%d.%m.%y, %H:%M:%S',
+    bracketed=True))
+register_format(Chat_Format(
+    'iphone2', r'\d+/\d+/\d\d \d+:\d+:\d+', '%d/%m/%y %H:%M:%S',
+    bracketed=True))
+register_format(Chat_Format(
+    'iphone_us', r'\d{1,2}/\d{1,2}/\d\d, \d{1,2}:\d\d:\d\d[ \u202f][AP]M',
+    '%m/%d/%y, %I:%M:%S %p', bracketed=True))
+register_format(Chat_Format(
+    'android', r'\d\d\.\d\d\.\d\d, \d\d:\d\d', '%d.%m.%y, %H:%M'))
+register_format(Chat_Format(
+    'android_4digit', r'\d\d\.\d\d\.\d{4}, \d\d:\d\d', '%d.%m.%Y, %H:%M'))
+register_format(Chat_Format(
+    'android_slash', r'\d\d/\d\d/\d{4}, \d\d:\d\d', '%d/%m/%Y, %H:%M'))
+register_format(Chat_Format(
+    'android_slash_us', r'\d\d/\d\d/\d{4}, \d\d:\d\d', '%m/%d/%Y, %H:%M'))
+register_format(Chat_Format(
+    'android_us', r'\d{1,2}/\d{1,2}/\d\d, \d{1,2}:\d\d[ \u202f][AP]M',
+    '%m/%d/%y, %I:%M %p'))
+
+
+def detect_format(lines, sample_size=format_sample_lines):
+    '''
+    Detects the format of a chat from its first lines. All registered
+    prefixes are combined into one regex, so every line is matched only
+    once. Lines which match no format (like the continuation of a message
+    over several lines, or empty lines) are ignored and the most frequent
+    prefix wins.
+
+    Returns: The Chat_Format
+
+    Raises:
+    ValueError: When no registered format matches the sample
+    '''
+    patterns = OrderedDict()
+    for chat_format in chat_formats.values():
+        patterns.setdefault(chat_format.line_pattern, []).append(chat_format)
+    groups = ['(?P<f' + str(i) + '>' + pattern + ')'
+              for i, pattern in enumerate(patterns)]
+    combined = re.compile('|'.join(groups))
+    candidates = list(patterns.values())
+
+    counts = Counter()
+    matched_lines = {}
+    for line in lines[:sample_size]:
+        match = combined.match(line.lstrip('\ufeff\u200e'))
+        if match is not None:
+            group = int(match.lastgroup[1:])
+            counts[group] += 1
+            matched_lines.setdefault(group, []).append(match.group(0))
+    if len(counts) == 0:
+        raise ValueError('The provided chat format is not known yet.')
+
+    group = counts.most_common(1)[0][0]
+    for chat_format in candidates[group]:
+        stamps = [chat_format.prefix.match(l).group('timestamp')
+                  for l in matched_lines[group]]
+        if not chat_format.decode(stamps, errors='coerce').isnull().any():
+            return chat_format
+    raise ValueError('The provided chat format is not known yet.')
+
+
+def decode_timestamps(chat_format, timestamps):
+    '''
+    Decodes the timestamps of a whole chat with chat_format or, if one of 
+    them doesn't fit, with the first other registered format with the same
+    prefix which decodes all of them. For example a US export whose first
+    lines all have a day up to 12 is detected as day/month order and only
+    a later "01/13/2021" rules that out.
+
+    Returns: Tuple of the Chat_Format and the DatetimeIndex
+
+    Raises:
+    ValueError: When no format with the prefix decodes all timestamps
+    '''
+    alternatives = [f for f in chat_formats.values()
+                    if f.line_pattern == chat_format.line_pattern and
+                    f is not chat_format]
+    try:
+        return chat_format, chat_format.decode(timestamps)
+    except ValueError as error:
+        for alternative in alternatives:
+            try:
+                return alternative, alternative.decode(timestamps)
+            except ValueError:
+                pass
+        raise error
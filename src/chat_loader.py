@@ -0,0 +1,536 @@
+import os
+import copy
+import queue
+import codecs
+import time
+import threading
+import pandas as pd
+from config import strings_to_exclude, preview_fraction, preview_min_bytes
+from config import upload_queue_lines, memory_budget, max_loaded_chats
+from whatsapp_analytics import Whatsapp_Analytics
+from result_cache import Result_Cache
+
+# Names of chats which were uploaded instead of read from a path start with
+# this prefix
+upload_prefix = 'upload:'
+
+
+class Chat_Loader():
+    '''
+    Loads Whatsapp_Analytics objects once and shares them between all
+    callers. Concurrent requests for the same (path, exclude, languages)
+    key wait for the one parse which is already running instead of
+    starting their own ("single flight").
+
+    Chats bigger than preview_min_bytes are first available as a preview
+    parsed from a sample of the file (see Whatsapp_Analytics), while the
+    full parse runs in a background thread. Compressed chats are always
+    parsed fully right away.
+
+    A chat which is already loaded with other languages is not parsed 
+    again, its messages are shared. At most max_chats chats are kept, the
+    least recently requested ones are dropped first. Uploaded chats can't
+    be parsed again, they are reduced to their aggregates instead.
+
+    Args of __init__:
+    - preview_fraction: Fraction of the file parsed for the preview
+    - preview_min_bytes: File size from which on a preview is created
+    - aggregates_only: Whether the chats are loaded without keeping their
+        message texts (see Whatsapp_Analytics), only the word frequencies
+        for the wordclouds are kept.
+    - memory_budget: Bytes which all loaded chats may use together, or 
+        None. Whenever a chat is loaded or a result is added to the cache 
+        of a loaded chat, the least recently requested chats free memory 
+        until the budget is met (see enforce_budget).
+    - max_chats: Number of chats which are kept loaded, every language 
+        variant and preview counts as one
+    '''
+
+    def __init__(self, preview_fraction=preview_fraction,
+                 preview_min_bytes=preview_min_bytes, aggregates_only=False,
+                 memory_budget=memory_budget, max_chats=max_loaded_chats):
+        self.preview_fraction = preview_fraction
+        self.preview_min_bytes = preview_min_bytes
+        self.aggregates_only = aggregates_only
+        self.memory_budget = memory_budget
+        self.max_chats = max_chats
+        self.lock = threading.Lock()
+        self.budget_lock = threading.Lock()
+        self.results = {}
+        self.flights = {}
+        self.last_used = {}
+
+
+    @staticmethod
+    def make_key(path, languages, exclude):
+        if isinstance(languages, str):
+            languages = [languages]
+        # The app names languages like "German", stop_words knows "german"
+        languages = [language.lower() for language in languages]
+        if not path.startswith(upload_prefix):
+            path = os.path.abspath(path)
+        return (path, tuple(exclude), tuple(languages))
+
+
+    def exists(self, path):
+        '''
+        Whether path is an existing chat file or an uploaded chat.
+        '''
+        if path is None:
+            return False
+        if not path.startswith(upload_prefix):
+            return os.path.exists(path)
+        with self.lock:
+            return any(key[0] == path for key in self.results)
+
+
+    def single_flight(self, key, create):
+        '''
+        Returns the result stored for key. If there is none, the first
+        caller runs create() while all other callers for the same key wait
+        for it and get the same result (or the same exception).
+        '''
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'result': None,
+                          'error': None}
+                self.flights[key] = flight
+
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+
+        try:
+            flight['result'] = create()
+            flight['result']._cache.on_insert = self.enforce_budget
+            with self.lock:
+                self.results[key] = flight['result']
+                self.last_used[key] = time.time()
+                uploads = self.evict()
+            # Outside of the lock, reducing a chat takes a while
+            for wa in uploads:
+                wa.fit_memory(0)
+            self.enforce_budget()
+            return flight['result']
+        except Exception as error:
+            flight['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight['done'].set()
+
+
+    def evict(self):
+        '''
+        Drops the least recently requested chats until at most max_chats
+        are loaded. Uploaded chats can't be parsed again, they are never
+        dropped but returned instead, so that the caller can reduce them to
+        their aggregates (see Whatsapp_Analytics.reduce_memory). Has to be
+        called with the lock held.
+
+        Returns: The uploaded chats which would have been dropped
+        '''
+        if self.max_chats is None:
+            return []
+        keys = sorted(self.results, key=lambda k: self.last_used.get(k, 0))
+        uploads = list()
+        for key in keys[:max(len(keys) - self.max_chats, 0)]:
+            if key[0].startswith(upload_prefix):
+                uploads.append(self.results[key])
+                continue
+            del self.results[key]
+            self.last_used.pop(key, None)
+        return uploads
+
+
+    def loaded_variant(self, key):
+        '''
+        A fully loaded chat with the same path and exclude as key, but 
+        possibly other languages, or None.
+        '''
+        with self.lock:
+            for k, wa in self.results.items():
+                if len(k) == 3 and k[:2] == key[:2]:
+                    return wa
+        return None
+
+
+    @staticmethod
+    def with_languages(wa, languages, exclude):
+        '''
+        A Whatsapp_Analytics object of the already parsed chat wa with other
+        languages. The messages of wa are shared, not copied.
+        '''
+        if wa.aggregates_only:
+            # The message texts are gone, but nothing except the 
+            # wordclouds depends on the languages
+            variant = copy.copy(wa)
+            variant.languages = languages
+            variant._cache = Result_Cache()
+            variant._part_bytes = dict()
+            return variant
+        variant = Whatsapp_Analytics(wa.path, languages=languages, 
+                                     exclude=exclude, 
+                                     pre_calculated_df=wa.df)
+        variant.format = getattr(wa, 'format', None)
+        return variant
+
+
+    def load(self, path, languages, exclude=strings_to_exclude):
+        '''
+        The fully parsed chat. Blocks until it is available.
+        '''
+        key = self.make_key(path, languages, exclude)
+        languages = list(key[2])
+
+        def create():
+            loaded = self.loaded_variant(key)
+            if loaded is not None:
+                return self.with_languages(loaded, languages, exclude)
+            wa = Whatsapp_Analytics(path, languages=languages,
+                                    exclude=exclude,
+                                    aggregates_only=self.aggregates_only,
+                                    token_frequencies=self.aggregates_only)
+            with self.lock:
+                self.results.pop(key + ('preview',), None)
+            return wa
+
+        return self.single_flight(key, create)
+
+
+    def load_lines(self, name, lines, languages, 
+                   exclude=strings_to_exclude):
+        '''
+        Parses a chat from an iterable of lines and stores it under name.
+        '''
+        key = self.make_key(name, languages, exclude)
+        languages = list(key[2])
+        return self.single_flight(
+            key, lambda: Whatsapp_Analytics(
+                name, languages=languages, exclude=exclude, lines=lines,
+                aggregates_only=self.aggregates_only,
+                token_frequencies=self.aggregates_only))
+
+
+    def load_upload(self, name, languages, exclude=strings_to_exclude):
+        '''
+        An uploaded chat with other languages than it was uploaded with. 
+        The already parsed messages are reused.
+        '''
+        key = self.make_key(name, languages, exclude)
+        languages = list(key[2])
+
+        def create():
+            uploaded = self.loaded_variant(key)
+            if uploaded is None:
+                raise ValueError('Unknown upload ' + name)
+            return self.with_languages(uploaded, languages, exclude)
+
+        return self.single_flight(key, create)
+
+
+    def start(self, path, languages, exclude=strings_to_exclude):
+        '''
+        Starts the full parse in a background thread, unless it is already
+        loaded or running.
+        '''
+        key = self.make_key(path, languages, exclude)
+        with self.lock:
+            if key in self.results or key in self.flights:
+                return
+        thread = threading.Thread(target=self.load,
+                                  args=(path, languages, exclude))
+        thread.daemon = True
+        thread.start()
+
+
+    def get(self, path, languages, exclude=strings_to_exclude):
+        '''
+        The fully parsed chat if it is available. Small chats are parsed
+        right away. For big chats the full parse is started in the
+        background and a preview is returned meanwhile.
+        '''
+        key = self.make_key(path, languages, exclude)
+        with self.lock:
+            wa = self.results.get(key)
+            if wa is not None:
+                self.last_used[key] = time.time()
+        if wa is not None:
+            return wa
+        if path.startswith(upload_prefix):
+            return self.load_upload(path, languages, exclude)
+        # Compressed files can't be sampled (see read_sample), their 
+        # preview would be a second full parse
+        if os.path.getsize(path) < self.preview_min_bytes or \
+                Whatsapp_Analytics.is_compressed(path) or \
+                self.loaded_variant(key) is not None:
+            return self.load(path, languages, exclude)
+
+        self.start(path, languages, exclude)
+        languages = list(key[2])
+
+        def create():
+            return Whatsapp_Analytics(path, languages=languages,
+                                      exclude=exclude,
+                                      sample_fraction=self.preview_fraction,
+                                      aggregates_only=self.aggregates_only,
+                                      token_frequencies=self.aggregates_only)
+
+        preview = self.single_flight(key + ('preview',), create)
+        with self.lock:
+            if key in self.results:
+                # The full parse finished while the preview was created
+                self.results.pop(key + ('preview',), None)
+                return self.results[key]
+            self.last_used[key + ('preview',)] = time.time()
+        return preview
+
+
+    def preview_fraction_of(self, path, languages,
+                            exclude=strings_to_exclude):
+        '''
+        The sample fraction of the preview which is currently shown for a
+        chat, or None if the chat is fully loaded or not requested yet.
+        '''
+        key = self.make_key(path, languages, exclude)
+        with self.lock:
+            if key in self.results:
+                return None
+            preview = self.results.get(key + ('preview',))
+        if preview is None:
+            return None
+        return preview.sample_fraction
+
+
+    def is_loading(self, path, languages, exclude=strings_to_exclude):
+        '''
+        Whether the chat or its preview is currently parsed.
+        '''
+        key = self.make_key(path, languages, exclude)
+        with self.lock:
+            return key in self.flights or key + ('preview',) in self.flights
+
+
+    def grouped_results(self):
+        '''
+        The loaded chats as lists of (key, Whatsapp_Analytics) pairs, one 
+        list per chat file with all of its language variants and its 
+        preview, the list with the least recently requested chat first. 
+        Has to be called with the lock held.
+        '''
+        groups = dict()
+        for key, wa in self.results.items():
+            groups.setdefault(key[:2], []).append((key, wa))
+        for group in groups.values():
+            group.sort(key=lambda item: self.last_used.get(item[0], 0))
+        return sorted(groups.values(), 
+                      key=lambda group: self.last_used.get(group[-1][0], 0))
+
+
+    @staticmethod
+    def used_bytes(chats):
+        '''
+        Bytes held by the (key, Whatsapp_Analytics) pairs chats together, 
+        the messages shared by language variants are counted once.
+        '''
+        seen = set()
+        return sum(wa.memory_usage(seen).sum() for key, wa in chats)
+
+
+    def memory_usage(self):
+        '''
+        Bytes held by every loaded chat (see Whatsapp_Analytics.memory_usage),
+        the least recently requested chat first. The messages shared by 
+        language variants are counted for the first of them only.
+        '''
+        with self.lock:
+            results = sorted(self.results.items(), 
+                             key=lambda item: self.last_used.get(item[0], 0))
+        seen = set()
+        rows = list()
+        for key, wa in results:
+            usage = wa.memory_usage(seen)
+            cache = usage[[i for i in usage.index if i.startswith('cache: ')]]
+            rows.append({'Chat': key[0], 
+                         'Languages': ', '.join(key[2]),
+                         'Preview': len(key) > 3,
+                         'Tables': wa.tables is not None,
+                         'Spilled': len(wa._cache.spilled),
+                         'Aggregates_only': wa.aggregates_only,
+                         'DataFrame': usage['df'] + usage['tables'],
+                         'Aggregates': usage['emoji_counts'] + 
+                                       usage['token_counts'],
+                         'Cache': cache.sum(),
+                         'Total': usage.sum()})
+        return pd.DataFrame(rows, columns=[
+            'Chat', 'Languages', 'Preview', 'Tables', 'Spilled', 
+            'Aggregates_only', 'DataFrame', 'Aggregates', 'Cache', 'Total'])
+
+
+    def enforce_budget(self):
+        '''
+        Frees memory until all loaded chats together use at most 
+        memory_budget bytes. The reduce_memory stages are applied one after
+        another, every stage to the least recently requested chats first, 
+        so the chats in use are degraded last and least. Every stage is 
+        applied to a chat only once. When all stages are applied and the 
+        budget still isn't met, the least recently requested chats are 
+        dropped, except for the most recent one and uploaded chats.
+
+        The language variants of a chat share its messages, which are only
+        freed once none of them holds them anymore. They are reduced and 
+        dropped together (see grouped_results).
+
+        Returns: The bytes used afterwards
+        '''
+        if self.memory_budget is None:
+            return None
+        # Concurrent callers would only free the same memory again
+        if not self.budget_lock.acquire(blocking=False):
+            return None
+        try:
+            with self.lock:
+                groups = self.grouped_results()
+                # Forget the chats which aren't loaded anymore
+                for key in list(self.last_used):
+                    if key not in self.results:
+                        del self.last_used[key]
+            chats = [chat for group in groups for chat in group]
+            used = self.used_bytes(chats)
+            for stage in Whatsapp_Analytics.memory_stages:
+                for group in groups:
+                    if used <= self.memory_budget:
+                        return used
+                    for key, wa in group:
+                        wa.reduce_memory(stage)
+                    used = self.used_bytes(chats)
+            for group in groups[:-1]:
+                if used <= self.memory_budget:
+                    break
+                # Uploaded chats can't be parsed again
+                if group[0][0][0].startswith(upload_prefix):
+                    continue
+                with self.lock:
+                    for key, wa in group:
+                        if self.results.get(key) is wa:
+                            del self.results[key]
+                            self.last_used.pop(key, None)
+                chats = [chat for chat in chats if chat not in group]
+                used = self.used_bytes(chats)
+            return used
+        finally:
+            self.budget_lock.release()
+
+
+class Chunked_Upload():
+    '''
+    A chat which is received in chunks of bytes, for example from a browser
+    upload. The chunks are split into lines which are parsed by a
+    background thread while further chunks are still arriving. At most
+    max_queued_lines lines wait for the parser, feeding blocks until the
+    parser catches up, so the memory of an upload stays bounded. Uploads 
+    which are never finished have to be aborted to stop their parser.
+
+    Args of __init__:
+    - loader: The Chat_Loader in which the parsed chat is stored
+    - name: Name of the chat in the loader, has to start with upload_prefix
+    - languages, exclude: see Whatsapp_Analytics
+    '''
+
+    def __init__(self, loader, name, languages=['german'],
+                 exclude=strings_to_exclude,
+                 max_queued_lines=upload_queue_lines):
+        self.loader = loader
+        self.name = name
+        self.languages = languages
+        self.exclude = exclude
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.rest = ''
+        self.lines = queue.Queue(maxsize=max_queued_lines)
+        self.error = None
+        self.aborted = False
+        self.last_active = time.time()
+        self.thread = threading.Thread(target=self.parse)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def queued_lines(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                if self.aborted:
+                    # Nothing of the chat is stored in the loader
+                    raise RuntimeError('Upload aborted')
+                return
+            yield line
+
+
+    def parse(self):
+        try:
+            self.loader.load_lines(self.name, self.queued_lines(),
+                                   self.languages, self.exclude)
+        except Exception as error:
+            self.error = error
+
+
+    def put(self, line):
+        while True:
+            try:
+                self.lines.put(line, timeout=1)
+                return
+            except queue.Full:
+                # The parser stopped consuming, most likely because the
+                # format of the chat is not known
+                if not self.thread.is_alive():
+                    raise self.error or RuntimeError('Parsing stopped')
+
+
+    def feed(self, data):
+        '''
+        Adds the next chunk of bytes of the chat.
+        '''
+        self.last_active = time.time()
+        lines = (self.rest + self.decoder.decode(data)).split('\n')
+        self.rest = lines.pop()
+        for line in lines:
+            self.put(line.rstrip('\r'))
+
+
+    def idle_seconds(self):
+        return time.time() - self.last_active
+
+
+    def abort(self):
+        '''
+        Stops the parser without storing the chat.
+        '''
+        self.aborted = True
+        while True:
+            try:
+                self.lines.get_nowait()
+            except queue.Empty:
+                break
+        self.lines.put(None)
+
+
+    def finish(self):
+        '''
+        Marks the end of the chat, waits for the parser and returns the
+        parsed Whatsapp_Analytics object.
+        '''
+        last = self.rest + self.decoder.decode(b'', final=True)
+        if len(last) > 0:
+            self.put(last.rstrip('\r'))
+        self.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.loader.get(self.name, self.languages, self.exclude)
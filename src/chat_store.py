@@ -0,0 +1,320 @@
+import os
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+from config import strings_to_exclude, chat_store_path
+from whatsapp_analytics import Whatsapp_Analytics
+
+
+class Chat_Store():
+    '''
+    Persistent store of many parsed chats in a local SQLite database. Every
+    chat is stored once as normalized messages (timestamps as unix seconds,
+    senders as ids into a participants table) together with a table of
+    daily aggregates per participant, so chats can be compared without
+    parsing their .txt files again.
+
+    Args of __init__:
+    - path: Path of the database file, it is created if it doesn't exist.
+        ":memory:" gives a temporary store.
+    '''
+
+    schema = '''
+    CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        format TEXT,
+        exclude TEXT,
+        n_messages INTEGER,
+        first_timestamp INTEGER,
+        last_timestamp INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS participants (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL REFERENCES chats(id),
+        name TEXT NOT NULL,
+        UNIQUE (chat_id, name)
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        chat_id INTEGER NOT NULL REFERENCES chats(id),
+        position INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        participant_id INTEGER NOT NULL REFERENCES participants(id),
+        message TEXT,
+        PRIMARY KEY (chat_id, position)
+    );
+    CREATE INDEX IF NOT EXISTS messages_by_time
+        ON messages (chat_id, timestamp);
+    CREATE INDEX IF NOT EXISTS messages_by_sender
+        ON messages (chat_id, participant_id);
+    CREATE TABLE IF NOT EXISTS daily (
+        chat_id INTEGER NOT NULL REFERENCES chats(id),
+        day TEXT NOT NULL,
+        participant_id INTEGER NOT NULL REFERENCES participants(id),
+        messages INTEGER,
+        words INTEGER,
+        chars INTEGER,
+        PRIMARY KEY (chat_id, day, participant_id)
+    );
+    '''
+
+    def __init__(self, path=chat_store_path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(self.schema)
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @staticmethod
+    def name_of(wa):
+        if os.path.exists(wa.path):
+            return os.path.abspath(wa.path)
+        return wa.path
+
+
+    def chat_id(self, name):
+        row = self.connection.execute('SELECT id FROM chats WHERE name = ?',
+                                      (name,)).fetchone()
+        if row is None:
+            raise KeyError('No chat named ' + name + ' in ' + self.path)
+        return row[0]
+
+
+    def __contains__(self, name):
+        return self.connection.execute('SELECT 1 FROM chats WHERE name = ?',
+                                       (name,)).fetchone() is not None
+
+
+    def add(self, wa, name=None, replace=False):
+        '''
+        Stores a parsed chat. All rows are inserted in one transaction.
+
+        Args:
+        - wa: The Whatsapp_Analytics object, it must not be a preview
+        - name: Name under which the chat is stored, defaults to the
+            absolute path of the chat
+        - replace: Whether an already stored chat of the same name is
+            replaced. Otherwise this raises a ValueError.
+
+        Returns: The id of the chat in the store
+        '''
+        if wa.sample_fraction < 1:
+            raise ValueError('Previews of chats can not be stored')
+        wa.require_messages('Storing a chat')
+        name = name or self.name_of(wa)
+        df = wa.df
+        seconds = df['Timestamp'].values.astype('datetime64[s]') \
+            .astype('int64')
+        codes = wa.calc_writer_codes()
+        messages = df['Message'].values
+
+        with self.connection:
+            if name in self:
+                if not replace:
+                    raise ValueError(name + ' is already stored')
+                self.delete_rows(self.chat_id(name))
+            cursor = self.connection.execute(
+                'INSERT INTO chats (name, format, exclude, n_messages, '
+                'first_timestamp, last_timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, getattr(wa, 'format', None), json.dumps(wa.exclude),
+                 len(df), int(seconds.min()) if len(df) else None,
+                 int(seconds.max()) if len(df) else None))
+            chat_id = cursor.lastrowid
+
+            self.connection.executemany(
+                'INSERT INTO participants (chat_id, name) VALUES (?, ?)',
+                ((chat_id, n) for n in wa.names))
+            ids = dict(self.connection.execute(
+                'SELECT name, id FROM participants WHERE chat_id = ?',
+                (chat_id,)))
+            participant_ids = np.array([ids[n] for n in wa.names],
+                                       dtype='int64')[codes]
+
+            self.connection.executemany(
+                'INSERT INTO messages (chat_id, position, timestamp, '
+                'participant_id, message) VALUES (?, ?, ?, ?, ?)',
+                ((chat_id, i, int(s), int(p), m) for i, (s, p, m)
+                 in enumerate(zip(seconds, participant_ids, messages))))
+
+            daily = pd.DataFrame({
+                'day': df['Timestamp'].dt.strftime('%Y-%m-%d').values,
+                'participant_id': participant_ids,
+                'messages': 1,
+                'words': df['Message'].str.count(' ').values + 1,
+                'chars': df['Message'].str.len().values})
+            daily = daily.groupby(['day', 'participant_id']).sum() \
+                .reset_index()
+            self.connection.executemany(
+                'INSERT INTO daily (chat_id, day, participant_id, messages, '
+                'words, chars) VALUES (?, ?, ?, ?, ?, ?)',
+                ((chat_id, d, int(p), int(n), int(w), int(c)) for d, p, n, w, c
+                 in daily[['day', 'participant_id', 'messages', 'words',
+                           'chars']].itertuples(index=False)))
+        return chat_id
+
+
+    def delete_rows(self, chat_id):
+        for table in ['daily', 'messages', 'participants']:
+            self.connection.execute('DELETE FROM ' + table +
+                                    ' WHERE chat_id = ?', (chat_id,))
+        self.connection.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
+
+
+    def delete(self, name):
+        with self.connection:
+            self.delete_rows(self.chat_id(name))
+
+
+    def load_df(self, name):
+        '''
+        The DataFrame of a stored chat as created by
+        Whatsapp_Analytics.whatsapp_to_df.
+        '''
+        df = pd.read_sql_query(
+            'SELECT m.timestamp AS Timestamp, p.name AS Written_by, '
+            'm.message AS Message FROM messages m JOIN participants p '
+            'ON m.participant_id = p.id WHERE m.chat_id = ? '
+            'ORDER BY m.position', self.connection,
+            params=(self.chat_id(name),))
+        df['Timestamp'] = pd.to_datetime(df['Timestamp'], unit='s')
+        return df
+
+
+    def load(self, name, languages=['german'], exclude=None, theme='dark'):
+        '''
+        A Whatsapp_Analytics object of a stored chat. The messages are
+        excluded already when the chat was stored, exclude only removes
+        further ones.
+        '''
+        df = self.load_df(name)
+        if exclude:
+            df = df.loc[~df['Message'].apply(
+                lambda m: any(string in m for string in exclude))]
+        stored = self.connection.execute(
+            'SELECT format, exclude FROM chats WHERE name = ?',
+            (name,)).fetchone()
+        wa = Whatsapp_Analytics(name, languages=languages,
+                                exclude=json.loads(stored[1]) +
+                                list(exclude or []),
+                                pre_calculated_df=df, theme=theme)
+        wa.format = stored[0]
+        return wa
+
+
+    def add_chats(self, paths, languages=['german'],
+                  exclude=strings_to_exclude, replace=False):
+        '''
+        Parses and stores every chat in paths which isn't stored yet (or
+        all of them, if replace).
+
+        Returns: List of the names of the newly stored chats
+        '''
+        added = list()
+        for path in paths:
+            name = os.path.abspath(path)
+            if name in self and not replace:
+                continue
+            wa = Whatsapp_Analytics(path, languages=languages,
+                                    exclude=exclude)
+            self.add(wa, name=name, replace=replace)
+            added.append(name)
+        return added
+
+
+    ########################################################################
+    # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~# 
+    # CROSS CHAT QUERIES  ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ #
+    # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~#
+    ########################################################################
+
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+
+    def chats(self):
+        '''
+        One row of summary statistics per stored chat, computed from the
+        daily aggregates only.
+        '''
+        df = self.query(
+            'SELECT c.name AS Chat, c.format AS Format, '
+            'c.n_messages AS Messages, '
+            '(SELECT COUNT(*) FROM participants p WHERE p.chat_id = c.id) '
+            'AS Participants, '
+            'COUNT(DISTINCT d.day) AS Active_days, '
+            'SUM(d.words) AS Words, SUM(d.chars) AS Characters, '
+            'c.first_timestamp AS First_message, '
+            'c.last_timestamp AS Last_message '
+            'FROM chats c LEFT JOIN daily d ON d.chat_id = c.id '
+            'GROUP BY c.id ORDER BY c.n_messages DESC')
+        df['First_message'] = pd.to_datetime(df['First_message'], unit='s')
+        df['Last_message'] = pd.to_datetime(df['Last_message'], unit='s')
+        df['Messages_per_active_day'] = np.round(
+            df['Messages'] / df['Active_days'].clip(lower=1), 1)
+        return df
+
+
+    def participant_ranking(self, n=20, by='messages'):
+        '''
+        The n participants with the most messages (or words, chars) summed
+        over all stored chats, with the number of chats they write in.
+        '''
+        if by not in ['messages', 'words', 'chars']:
+            raise ValueError('by has to be messages, words or chars')
+        return self.query(
+            'SELECT p.name AS Participant, COUNT(DISTINCT p.chat_id) AS Chats,'
+            ' SUM(d.messages) AS Messages, SUM(d.words) AS Words, '
+            'SUM(d.chars) AS Characters FROM daily d JOIN participants p '
+            'ON d.participant_id = p.id GROUP BY p.name '
+            'ORDER BY SUM(d.' + by + ') DESC LIMIT ?', (n,))
+
+
+    def daily_counts(self, names=None):
+        '''
+        Number of messages per day (rows) and chat (columns).
+        '''
+        sql = ('SELECT c.name AS Chat, d.day AS Day, SUM(d.messages) AS '
+               'Messages FROM daily d JOIN chats c ON d.chat_id = c.id')
+        params = ()
+        if names is not None:
+            sql += ' WHERE c.name IN (' + ', '.join('?' * len(names)) + ')'
+            params = tuple(names)
+        df = self.query(sql + ' GROUP BY c.name, d.day', params)
+        df['Day'] = pd.to_datetime(df['Day'])
+        return df.pivot(index='Day', columns='Chat', values='Messages') \
+            .fillna(0).astype('int64')
+
+
+    def messages_between(self, start, end, names=None):
+        '''
+        All messages of the stored chats (or the chats in names) written
+        between the timestamps start and end. When names are given, the
+        (chat, timestamp) index is used.
+        '''
+        start = int(pd.Timestamp(start).value // 10 ** 9)
+        end = int(pd.Timestamp(end).value // 10 ** 9)
+        sql = ('SELECT c.name AS Chat, m.timestamp AS Timestamp, '
+               'p.name AS Written_by, m.message AS Message FROM messages m '
+               'JOIN chats c ON m.chat_id = c.id JOIN participants p '
+               'ON m.participant_id = p.id '
+               'WHERE m.timestamp BETWEEN ? AND ?')
+        params = (start, end)
+        if names is not None:
+            sql += ' AND c.name IN (' + ', '.join('?' * len(names)) + ')'
+            params += tuple(names)
+        df = self.query(sql + ' ORDER BY m.timestamp', params)
+        df['Timestamp'] = pd.to_datetime(df['Timestamp'], unit='s')
+        return df
@@ -1,5 +1,7 @@
 from plotly import graph_objs as go
 import numpy as np
+import colorsys
+import os
 
 
 def convert_rgb_to_plotlycolor(rgb_vec):
@@ -98,8 +100,18 @@ strings_to_exclude = [
 ]
 
 
-# A list of colors. Later randomly there will be picked x colors of this list
-# where x stands for the number of chat participants. 
+# Minutes of silence after which the next message is considered to start a 
+# new conversation session.
+session_gap_minutes = 60
+
+
+# Maximum number of points per trace in the chronology plot before it is 
+# aggregated to a coarser resolution (day -> week -> month).
+chronology_max_buckets = 500
+
+
+# A list of colors. The most active participants of a chat get these colors,
+# see make_palette for chats with more participants.
 nice_colors = [
    [255, 0, 127], 
    [127, 0, 255],
@@ -116,13 +128,88 @@ nice_colors = [
        
 nice_colors = [convert_rgb_to_plotlycolor(c) for c in nice_colors]
 
+# Color of the aggregated trace of all participants which are not shown
+# individually
+others_color = convert_rgb_to_plotlycolor([160, 160, 160])
+
+
+def make_palette(n):
+    '''
+    Deterministic list of n plotly colors of any size. The first colors are
+    the nice_colors, further ones are spread over the hue circle with the 
+    golden ratio so that neighbouring colors stay distinguishable.
+    '''
+    colors = list(nice_colors[:n])
+    for i in range(n - len(colors)):
+        hue = (i * 0.618033988749895) % 1
+        rgb = colorsys.hsv_to_rgb(hue, 0.6, 1)
+        colors.append(convert_rgb_to_plotlycolor([int(255 * c) for c in rgb]))
+    return colors
+
+
+# Number of most active participants which are plotted as individual traces.
+# All others are aggregated into one "Others" trace.
+max_plotted_participants = 10
+
+
+# Preview of huge chats: the fraction of the file which is parsed first, the 
+# number of evenly spaced chunks it is read in and the file size (bytes) from
+# which on a preview is shown at all.
+preview_fraction = 0.05
+preview_chunks = 64
+preview_min_bytes = 5 * 1024 ** 2
+
+
+# Chats uploaded through the browser are parsed while they arrive. This is the
+# maximum number of received lines waiting for the parser before the upload 
+# is slowed down, which bounds the memory of an upload.
+upload_queue_lines = 20000
+# Uploads which receive no chunk for this many seconds are aborted
+upload_idle_seconds = 600
+
+
+# Number of lines at the beginning of a chat which are used to detect its 
+# format
+format_sample_lines = 50
+
+
+# SQLite database in which parsed chats are stored (see chat_store.py)
+chat_store_path = 'whatsapp_chats.sqlite'
 
 
+# Wordclouds for the app are rendered in the background by this number of
+# workers and cached as png files in the directory, of which at most 
+# wordcloud_cache_files are kept. wordcloud_size is the width and height in
+# pixels.
+wordcloud_size = 1500
+wordcloud_workers = 2
+wordcloud_cache_directory = os.getcwd() + '/wordclouds/'
+wordcloud_cache_files = 200
 
 
+# The JSON aggregates (see Whatsapp_Analytics.calc_aggregates) contain the 
+# max_emojis most used emojis and the number of replies within these respond
+# times in minutes
+max_emojis = 50
+respond_time_bins = [0, 1, 2, 5, 10, 30, 60, 120, 360, 720, 1440]
 
 
+# Number of threads which compute the plots of an overview concurrently
+overview_workers = 4
 
 
+# Memory budget in bytes of all chats loaded by a Chat_Loader (see 
+# Whatsapp_Analytics.memory_usage), None for no budget. Above it the least 
+# recently used chats first drop their per participant tables, then spill 
+# their cached results to spill_directory and finally keep only aggregates.
+# Cached results smaller than spill_min_bytes are never spilled.
+memory_budget = None
+spill_directory = os.getcwd() + '/spilled/'
+spill_min_bytes = 64 * 1024
 
 
+# Number of chats (every language variant and preview counts as one) which 
+# are kept loaded by a Chat_Loader, the least recently requested ones are 
+# dropped first. Uploaded chats are never dropped, they are reduced to 
+# their aggregates instead.
+max_loaded_chats = 10
@@ -0,0 +1,127 @@
+import json
+import numpy as np
+import plotly.graph_objs as go
+from plotly.offline import get_plotlyjs
+from plotly.utils import PlotlyJSONEncoder
+
+# plotly.js version which is bundled with plotly 3.4
+plotlyjs_cdn = 'https://cdn.plot.ly/plotly-1.42.5.min.js'
+
+# Every figure is stored as JSON in its own script tag and only drawn when its
+# placeholder scrolls into view, so opening a report with many figures stays
+# fast.
+template = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+{plotlyjs}
+<style>
+body {{ background: {background}; color: {color}; font-family: sans-serif;
+       margin: 0 auto; max-width: 1400px; padding: 20px; }}
+.figure {{ min-height: {height}px; margin-bottom: 40px; }}
+.summary {{ overflow-x: auto; margin-bottom: 40px; }}
+.summary table {{ border-collapse: collapse; font-size: 14px; }}
+.summary td, .summary th {{ border: 1px solid grey; padding: 4px 8px; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<div class="summary">{summary}</div>
+{figures}
+<script>
+(function() {{
+    function draw(div) {{
+        var figure = JSON.parse(
+            document.getElementById(div.id + '-data').textContent);
+        Plotly.newPlot(div, figure.data, figure.layout, {{responsive: true}});
+    }}
+    var divs = document.querySelectorAll('.figure');
+    if (!('IntersectionObserver' in window)) {{
+        Array.prototype.forEach.call(divs, draw);
+        return;
+    }}
+    var observer = new IntersectionObserver(function(entries) {{
+        entries.forEach(function(entry) {{
+            if (entry.isIntersecting) {{
+                observer.unobserve(entry.target);
+                draw(entry.target);
+            }}
+        }});
+    }}, {{rootMargin: '500px'}});
+    Array.prototype.forEach.call(divs, function(div) {{
+        observer.observe(div);
+    }});
+}})();
+</script>
+</body>
+</html>
+'''
+
+figure_template = '''<div class="figure" id="figure-{i}"></div>
+<script type="application/json" id="figure-{i}-data">{data}</script>'''
+
+
+def bin_histogram(trace):
+    '''
+    Replaces a histogram trace by a bar trace of its bin counts, so the
+    report holds one number per bin instead of one per message. The bins
+    given in xbins are kept, missing ones are chosen by numpy.
+    '''
+    x = np.asarray(trace['x'], dtype='float64')
+    x = x[~np.isnan(x)]
+    xbins = trace['xbins']
+    if xbins is not None and xbins['size'] is not None and len(x) > 0:
+        start = xbins['start'] if xbins['start'] is not None else x.min()
+        end = xbins['end'] if xbins['end'] is not None else x.max()
+        size = xbins['size']
+        edges = np.arange(start, end + size, size)
+    else:
+        edges = np.histogram_bin_edges(x, bins='auto') if len(x) > 0 \
+            else np.zeros(1)
+    counts, edges = np.histogram(x, bins=edges)
+    return go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts,
+                  width=np.diff(edges), name=trace['name'],
+                  marker=trace['marker'].to_plotly_json())
+
+
+def figure_json(traces, layout):
+    '''
+    Compact JSON of a figure as understood by Plotly.newPlot.
+    '''
+    traces = [bin_histogram(t) if t['type'] == 'histogram' else t
+              for t in traces]
+    fig = go.Figure(traces, layout)
+    data = json.dumps({'data': fig['data'], 'layout': fig['layout']},
+                      cls=PlotlyJSONEncoder, separators=(',', ':'))
+    # The JSON is placed inside a script tag which must not be closed by it
+    return data.replace('</', '<\\/')
+
+
+def render_report(title, figures, summary='', include_plotlyjs=True,
+                  background='white', color='black', height=800):
+    '''
+    A single html page with all figures, which loads plotly.js only once.
+
+    Args:
+    - title: Heading and title of the page
+    - figures: List of (traces, layout) tuples
+    - summary: Html which is shown above the figures, like a table
+    - include_plotlyjs: True to embed plotly.js into the page, so it works
+        offline. "cdn" to load it from the plotly CDN, which keeps the file
+        small.
+    - background, color, height: Style of the page and the height of the
+        placeholders of not yet drawn figures
+    '''
+    if include_plotlyjs == 'cdn':
+        plotlyjs = '<script src="' + plotlyjs_cdn + '"></script>'
+    elif include_plotlyjs:
+        plotlyjs = '<script type="text/javascript">' + get_plotlyjs() + \
+            '</script>'
+    else:
+        plotlyjs = ''
+    figures = '\n'.join(figure_template.format(i=i, data=figure_json(*f))
+                        for i, f in enumerate(figures))
+    return template.format(title=title, plotlyjs=plotlyjs, summary=summary,
+                           figures=figures, background=background,
+                           color=color, height=height)
@@ -0,0 +1,213 @@
+import os
+import sys
+import uuid
+import pickle
+import hashlib
+import weakref
+import threading
+import numpy as np
+import pandas as pd
+from config import spill_directory, spill_min_bytes
+
+
+def nbytes(value, seen=None):
+    '''
+    Approximate number of bytes held by value, including everything it
+    references. Objects which are referenced more than once are counted
+    once.
+    '''
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(nbytes(k, seen) + nbytes(v, seen)
+                    for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(nbytes(v, seen) for v in value)
+    elif hasattr(value, '__dict__'):
+        size += nbytes(vars(value), seen)
+    return size
+
+
+class Result_Cache(dict):
+    '''
+    The dict of cached results of a Whatsapp_Analytics object, whose
+    entries can be spilled to disk to free memory. A spilled entry still
+    counts as contained and is loaded back into memory (and its file
+    deleted) on the next access, so the calc_* methods don't notice it.
+    Iterating, len and values only see the entries in memory.
+
+    The size of every entry is measured once when it is stored (see 
+    nbytes), so the entries must not be modified afterwards. size is the
+    running total of the entries in memory.
+
+    Args of __init__:
+    - directory: Directory of the spilled entries, one pickle file each.
+        The files are deleted together with the cache.
+    - on_insert: Function called without arguments whenever an entry is
+        added to memory, by storing it or by loading it back from disk, or
+        None
+    '''
+
+    def __init__(self, directory=spill_directory, on_insert=None):
+        super().__init__()
+        self.directory = directory
+        self.on_insert = on_insert
+        self.prefix = uuid.uuid4().hex
+        self.spilled = {}
+        self.sizes = {}
+        self.size = 0
+        self.lock = threading.RLock()
+        weakref.finalize(self, self.remove_files, self.spilled)
+
+
+    @staticmethod
+    def remove_files(spilled):
+        for path in spilled.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        spilled.clear()
+
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.spilled
+
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            return self.unspill(key)
+
+
+    def __setitem__(self, key, value):
+        size = nbytes(value)
+        with self.lock:
+            self.discard_spilled(key)
+            if dict.__contains__(self, key):
+                self.size -= self.sizes[key]
+            dict.__setitem__(self, key, value)
+            self.sizes[key] = size
+            self.size += size
+        self.inserted()
+
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key in self.spilled and not dict.__contains__(self, key):
+                self.discard_spilled(key)
+                del self.sizes[key]
+                return
+            self.discard_spilled(key)
+            dict.__delitem__(self, key)
+            self.size -= self.sizes.pop(key)
+
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key in self.spilled:
+                self.load(key)
+            if dict.__contains__(self, key):
+                self.size -= self.sizes.pop(key)
+            return dict.pop(self, key, *default)
+
+
+    def clear(self):
+        with self.lock:
+            self.remove_files(self.spilled)
+            dict.clear(self)
+            self.sizes.clear()
+            self.size = 0
+
+
+    def inserted(self):
+        # Called outside of the lock, on_insert may spill this cache
+        if self.on_insert is not None:
+            self.on_insert()
+
+
+    def discard_spilled(self, key):
+        path = self.spilled.pop(key, None)
+        if path is not None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def path_for(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory,
+                            self.prefix + '-' + name + '.pickle')
+
+
+    def load(self, key):
+        with self.lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            path = self.spilled[key]
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            dict.__setitem__(self, key, value)
+            self.discard_spilled(key)
+            self.size += self.sizes[key]
+            return value
+
+
+    def unspill(self, key):
+        value = self.load(key)
+        self.inserted()
+        return value
+
+
+    def spill(self, min_bytes=spill_min_bytes):
+        '''
+        Writes all entries of at least min_bytes to disk and removes them
+        from memory. Entries which can't be pickled stay in memory.
+
+        Returns: Number of bytes removed from memory
+        '''
+        freed = 0
+        with self.lock:
+            for key in list(dict.keys(self)):
+                value = dict.__getitem__(self, key)
+                size = self.sizes[key]
+                if size < min_bytes:
+                    continue
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                path = self.path_for(key)
+                try:
+                    with open(path, 'wb') as file:
+                        pickle.dump(value, file, pickle.HIGHEST_PROTOCOL)
+                except (pickle.PicklingError, TypeError, AttributeError,
+                        OSError):
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                self.spilled[key] = path
+                dict.__delitem__(self, key)
+                self.size -= size
+                freed += size
+        return freed
+
+
+    def memory_usage(self):
+        '''
+        Bytes held by every entry in memory, as dict.
+        '''
+        with self.lock:
+            return {key: self.sizes[key] for key in dict.keys(self)}
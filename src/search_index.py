@@ -0,0 +1,143 @@
+import re
+import os
+import numpy as np
+
+
+class Chat_Index():
+    '''
+    Inverted index over the messages of a chat. Every term (lower case word)
+    points to the sorted ids of the messages containing it, where the id of
+    a message is its row position in the DataFrame the index was built from.
+    The posting lists of all terms are stored in one array and delta encoded,
+    so they compress well when saved and only the postings of the queried
+    terms have to be decoded.
+
+    Args of __init__:
+    - messages: Iterable of message strings. Leave it None when the index
+        is created from saved arrays (see load).
+    '''
+
+    token_pattern = re.compile(r'\w+')
+
+    def __init__(self, messages=None):
+        self.terms = list()
+        self.vocabulary = {}
+        self.offsets = np.zeros(1, dtype='int64')
+        self.deltas = np.zeros(0, dtype='uint32')
+        self.n_messages = 0
+        if messages is not None:
+            self.build(messages)
+
+
+    def tokenize(self, text):
+        return self.token_pattern.findall(text.lower())
+
+
+    def build(self, messages):
+        vocabulary = {}
+        term_ids = list()
+        message_ids = list()
+        n_messages = 0
+        for i, message in enumerate(messages):
+            n_messages += 1
+            for token in set(self.tokenize(message)):
+                term_id = vocabulary.setdefault(token, len(vocabulary))
+                term_ids.append(term_id)
+                message_ids.append(i)
+
+        term_ids = np.array(term_ids, dtype='int64')
+        message_ids = np.array(message_ids, dtype='uint32')
+
+        # Messages were visited in order, so a stable sort by term keeps
+        # every posting list sorted by message id
+        order = np.argsort(term_ids, kind='mergesort')
+        message_ids = message_ids[order]
+        lengths = np.bincount(term_ids, minlength=len(vocabulary))
+        offsets = np.zeros(len(vocabulary) + 1, dtype='int64')
+        np.cumsum(lengths, out=offsets[1:])
+
+        # Every posting list starts with an absolute id, followed by the
+        # differences to the previous id
+        deltas = message_ids.copy()
+        deltas[1:] -= message_ids[:-1]
+        firsts = offsets[:-1][lengths > 0]
+        deltas[firsts] = message_ids[firsts]
+
+        self.vocabulary = vocabulary
+        self.terms = sorted(vocabulary, key=vocabulary.get)
+        self.offsets = offsets
+        self.deltas = deltas
+        self.n_messages = n_messages
+
+
+    def postings(self, term):
+        '''
+        Sorted ids of all messages which contain the term.
+        '''
+        term_id = self.vocabulary.get(term.lower())
+        if term_id is None:
+            return np.zeros(0, dtype='int64')
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return np.cumsum(self.deltas[start:end], dtype='int64')
+
+
+    def search(self, query):
+        '''
+        Ids of all messages which contain every word of the query. The
+        posting lists are intersected starting with the shortest one.
+        '''
+        tokens = self.tokenize(query)
+        if len(tokens) == 0:
+            return np.zeros(0, dtype='int64')
+        lists = sorted((self.postings(t) for t in set(tokens)), key=len)
+        result = lists[0]
+        for postings in lists[1:]:
+            if len(result) == 0:
+                break
+            result = result[np.isin(result, postings, assume_unique=True)]
+        return result
+
+
+    def search_phrase(self, phrase, messages):
+        '''
+        Ids of all messages which contain the words of phrase in exactly
+        this order. Candidates are found with search and then verified on
+        the message texts.
+
+        Args:
+        - messages: The messages the index was built from, indexable by id
+        '''
+        tokens = self.tokenize(phrase)
+        candidates = self.search(phrase)
+        if len(tokens) < 2:
+            return candidates
+        pattern = re.compile(r'\b' + r'\W+'.join(map(re.escape, tokens)) +
+                             r'\b')
+        keep = [bool(pattern.search(messages[i].lower())) for i in candidates]
+        return candidates[np.array(keep, dtype=bool)]
+
+
+    def save(self, path):
+        np.savez_compressed(path, terms=np.array(self.terms, dtype=str),
+                            offsets=self.offsets, deltas=self.deltas,
+                            n_messages=self.n_messages)
+
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as arrays:
+            index.terms = arrays['terms'].tolist()
+            index.offsets = arrays['offsets']
+            index.deltas = arrays['deltas']
+            index.n_messages = int(arrays['n_messages'])
+        index.vocabulary = {term: i for i, term in enumerate(index.terms)}
+        return index
+
+
+    @staticmethod
+    def path_for(chat_path):
+        '''
+        Where the index of the chat at chat_path is saved.
+        '''
+        return os.path.splitext(chat_path)[0] + '.index.npz'
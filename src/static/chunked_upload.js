@@ -0,0 +1,72 @@
+// Adds a file input to the "uploadfile-container" of app.py and uploads the
+// chosen file in chunks to the /upload/<id>/chunk endpoint, where the chat is
+// parsed while it arrives. Afterwards the name of the uploaded chat is 
+// written into the "path" input, so that it can be used like a path to a 
+// chat.
+
+var CHUNK_SIZE = 1024 * 1024;
+
+function setPath(value) {
+    var input = document.getElementById('path');
+    // Dash inputs are React components, so the value has to be set through
+    // the native setter followed by an input event
+    var setter = Object.getOwnPropertyDescriptor(
+        window.HTMLInputElement.prototype, 'value').set;
+    setter.call(input, value);
+    input.dispatchEvent(new Event('input', {bubbles: true}));
+}
+
+function sendChunk(url, blob) {
+    return fetch(url, {method: 'POST', body: blob}).then(function (response) {
+        return response.json().then(function (result) {
+            if (!response.ok) {
+                throw new Error(result.error || response.statusText);
+            }
+            return result;
+        });
+    });
+}
+
+function uploadChat(file) {
+    var id = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    var base = '/upload/' + id;
+    var offset = 0;
+
+    function next() {
+        if (offset >= file.size) {
+            return sendChunk(base + '/finish', null);
+        }
+        var blob = file.slice(offset, offset + CHUNK_SIZE);
+        offset += CHUNK_SIZE;
+        setPath('Uploading ' + file.name + ' ... ' +
+                Math.min(100, Math.round(100 * offset / file.size)) + '%');
+        return sendChunk(base + '/chunk', blob).then(next);
+    }
+
+    next().then(function (result) {
+        setPath(result.path);
+    }).catch(function (error) {
+        setPath('Upload failed: ' + error.message);
+    });
+}
+
+document.addEventListener('change', function (event) {
+    if (event.target.id === 'uploadfile' && event.target.files.length > 0) {
+        uploadChat(event.target.files[0]);
+    }
+});
+
+// The Dash layout is rendered after this script is loaded, so wait for the
+// container to appear
+var addFileInput = setInterval(function () {
+    var container = document.getElementById('uploadfile-container');
+    if (container === null) {
+        return;
+    }
+    var input = document.createElement('input');
+    input.id = 'uploadfile';
+    input.type = 'file';
+    input.accept = '.txt';
+    container.appendChild(input);
+    clearInterval(addFileInput);
+}, 200);
@@ -1,18 +1,33 @@
 import re
 import numpy as np
 import pandas as pd
-from datetime import datetime
 from plotly.offline import plot
 import plotly.graph_objs as go
 from plotly import tools
 import emoji
 import matplotlib.pyplot as plt
-from config import my_plot_themes, strings_to_exclude, nice_colors
+from config import my_plot_themes, strings_to_exclude
+from config import session_gap_minutes, chronology_max_buckets
+from config import make_palette, others_color, max_plotted_participants
+from config import preview_chunks
+from config import format_sample_lines, wordcloud_size
+from config import max_emojis, respond_time_bins, overview_workers
+from chat_formats import detect_format, decode_timestamps
+from search_index import Chat_Index
+from aggregate_cube import Aggregate_Cube
+from result_cache import Result_Cache, nbytes
+from report import render_report
 from wordcloud import WordCloud
 from stop_words import get_stop_words
 from copy import copy
-import random
 import os
+import io
+import gzip
+import zipfile
+import threading
+from itertools import islice, chain
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import plotly.io as pio
 
 
@@ -21,12 +36,14 @@ class Whatsapp_Analytics():
     '''
     Analysis object of a whatsapp chat backup. Make a backup in the menu of 
     a chat in your mobile and select "without media". Than place the resulting
-    .txt file somewhere. There may be a lot of formats out there of this .txt 
+    .txt file (or the .zip file as exported, or a .gz compressed .txt file) 
+    somewhere. There may be a lot of formats out there of this .txt 
     file which are not covered by this object. In the latter case, you will 
     receive a corresponding error. 
     
     Args of __init__:
-    - path: Path where to find the original text file
+    - path: Path where to find the original text file. Zipped exports and
+        gzip compressed files are read directly without extracting them.
     - languages: List of languages which are spoken in the chat. This
         will latebe used to exclude stopwords in the wordcloud.
     - exclude: A list of strings, where every message which contains one
@@ -34,37 +51,157 @@ class Whatsapp_Analytics():
         intended to be used to exclude the messages which are sent
         by whatsapp itself (for example: media omitted) or when 
         you want to ignore some kind of "private" messages.
+    - top_n: Number of most active participants which are plotted 
+        individually. All others are aggregated into one "Others" trace.
+    - sample_fraction: If given (between 0 and 1), only this fraction of 
+        the file is parsed, read as evenly spaced chunks. This gives a fast
+        approximate preview of huge chats, see calc_preview_estimates.
+    - lines: Optional iterable of the lines of the chat which is parsed 
+        instead of reading path, for example while the chat is still being
+        uploaded. path is then only used as name of the chat.
+    - aggregates_only: If True, the message texts are dropped right after
+        parsing (see reduce_to_aggregates). This needs much less memory, 
+        but wordclouds (unless token_frequencies), the search and the term
+        usage are not available then.
+    - token_frequencies: Whether the word frequencies per participant are 
+        kept in aggregates_only mode, such that wordclouds still work.
     '''
     
+    # Words as found by WordCloud
+    token_pattern = re.compile(r"\w[\w']+")
+    
+    # Ways of freeing memory in the order they are applied, see 
+    # reduce_memory
+    memory_stages = ['drop_tables', 'spill_cache', 'aggregates_only']
+    
     def __init__(self, path, languages=['german'], 
                  exclude = strings_to_exclude, pre_calculated_df=None, 
-                 theme = 'dark'):
+                 theme = 'dark', top_n=max_plotted_participants,
+                 sample_fraction=None, lines=None, aggregates_only=False,
+                 token_frequencies=False):
         self.path = path
         self.exclude = exclude
+        self.sample_fraction = 1.0
+        self.sample_population = 1
+        self.sample_chunks = None
+        # Sizes of the parts counted by memory_usage
+        self._part_bytes = dict()
         if pre_calculated_df is not None:
             self.df = pre_calculated_df
         else:
-            self.df = self.whatsapp_to_df(self.path, exclude=self.exclude)
-        tables = list()
-        names = list()
-        for name in np.unique(self.df['Written_by']):
-            tables.append(self.df.loc[self.df['Written_by'] == name, :])
-            names.append(name)
-        self.tables = tables
-        self.names = names
+            self.df = self.whatsapp_to_df(self.path, exclude=self.exclude,
+                                          sample_fraction=sample_fraction,
+                                          lines=lines)
+        if 'Chunk' in self.df.columns:
+            self.sample_chunks = self.df.pop('Chunk').values
+        self.names = list(np.unique(self.df['Written_by']))
+        self.make_tables()
         self.languages = languages
+        self._cache = Result_Cache()
+        self.aggregates_only = False
+        self.emoji_counts = None
+        self.token_counts = None
+        self.memory_stage = 0
+        self._reduce_lock = threading.Lock()
+        self.weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                         'Friday', 'Saturday', 'Sunday']
+        self.top_n = top_n
         
-        ind = random.sample(range(len(nice_colors)), len(self.names))
-        self.colors = [nice_colors[i] for i in ind]
+        # Participants ordered by number of messages, the most active ones
+        # get the first colors of the palette
+        names = self.names
+        counts = np.bincount(self.calc_writer_codes(), minlength=len(names))
+        order = np.argsort(-counts, kind='mergesort')
+        self.ranking = [names[i] for i in order]
+        self.colors = [None] * len(names)
+        for color, i in zip(make_palette(len(names)), order):
+            self.colors[i] = color
         self.theme = theme
         if theme in my_plot_themes.keys():
             self.plot_theme = my_plot_themes[theme]
         else:
             raise ValueError('Only "light" and "dark" are valid theme parameters')
+        if aggregates_only:
+            self.reduce_to_aggregates(token_frequencies)
+        
+        
+    def make_tables(self):
+        '''
+        Splits self.df into one table per participant, ordered like 
+        self.names.
+        '''
+        self.tables = self.split_tables(self.df)
+        self._part_bytes.pop('tables', None)
+    
+    
+    def split_tables(self, df):
+        return [df.loc[df['Written_by'] == name, :] for name in self.names]
+    
+    
+    def reduce_to_aggregates(self, token_frequencies=False):
+        '''
+        Replaces the message texts by the features which are derived from 
+        them: the "Words" and "Chars" columns of self.df with the message 
+        sizes, the emoji counts per participant and, if token_frequencies, 
+        the word counts per participant (used for wordclouds). Everything 
+        else works on timestamps and writers only and keeps working.
+        
+        Other threads may use the chat meanwhile (see 
+        Chat_Loader.enforce_budget). Everything is built aside and then 
+        assigned with self.df last, so a reader which takes self.df once 
+        and finds no "Message" column always finds the aggregates.
+        '''
+        with self._reduce_lock:
+            if self.aggregates_only:
+                return
+            df = self.df
+            emoji_counts = self.calc_emoji_counts()
+            token_counts = None
+            if token_frequencies:
+                codes = self.calc_writer_codes()
+                token_counts = {name: Counter() for name in self.names}
+                counters = [token_counts[name] for name in self.names]
+                for code, message in zip(codes, df['Message'].values):
+                    counters[code].update(
+                        self.token_pattern.findall(message.lower()))
+            words, chars = self.calc_message_lengths()
+            reduced = df.drop('Message', axis=1)
+            reduced['Words'] = words.astype('int32')
+            reduced['Chars'] = chars.astype('int32')
+            reduced['Written_by'] = pd.Categorical(reduced['Written_by'], 
+                                                   categories=self.names)
+            tables = self.split_tables(reduced) \
+                if self.tables is not None else None
+            
+            self.emoji_counts = emoji_counts
+            self.token_counts = token_counts
+            self.tables = tables
+            self.aggregates_only = True
+            self.df = reduced
+            self._part_bytes = dict()
+            for key in ['search_index', 'message_lengths']:
+                if key in self._cache:
+                    del self._cache[key]
+    
+    
+    def drop_tables(self):
+        '''
+        Frees the per participant tables. table_of then selects the 
+        messages of a participant from self.df on every call.
+        '''
+        self.tables = None
+        self._part_bytes.pop('tables', None)
+    
+    
+    def require_messages(self, what, df=None):
+        if 'Message' not in (self.df if df is None else df).columns:
+            raise ValueError(what + ' needs the message texts, which are '
+                             'not kept in aggregates_only mode')
       
         
     def whatsapp_to_df(self, path_of_whatsapp_text=None,
-                       exclude = strings_to_exclude):
+                       exclude = strings_to_exclude, sample_fraction=None,
+                       lines=None):
         '''
         Takes a path to a whatsapp chat backup and produces a clean DataFrame.
         
@@ -74,105 +211,175 @@ class Whatsapp_Analytics():
             - Timestamp: Timestamp of message
             - Written_by: Name of chat member who has written the message
             - Message: Content of message
+          When sample_fraction is given, a fourth column Chunk holds the 
+          number of the sampled chunk every message was read from.
             
         Raises:
         ValueError: When format of that is not recognized 
         timestamp, written by, message columns. If the function is unable to
-        detect the format of the given chat, an error raises. 
+        detect the format of the given chat, an error raises. New formats 
+        can be added with chat_formats.register_format.
         '''
 
-        with open(path_of_whatsapp_text) as file:
-            chat = file.read().split('\n')[:-1]
+        if sample_fraction is None:
+            # The lines are streamed through the parser, so the whole text
+            # is never held in memory
+            if lines is None:
+                lines = self.read_chat_lines(path_of_whatsapp_text)
+            lines = iter(lines)
+            first_lines = list(islice(lines, format_sample_lines))
+            chunks = [chain(first_lines, lines)]
+        else:
+            chunks = self.read_sample(path_of_whatsapp_text, sample_fraction)
+            first_lines = chunks[0][0:format_sample_lines]
        
-        # Format detection:
-        # First, a regex is used to seperate the message from the timestamp and
-        # name. Second, the corresponding timestamp will be extracted with 
-        # the timestamp-part of the first regex. Last, the correponding format
-        # of the timestamp is specified to pass it later to pd.to_datetime
-        
-        formats = {'iphone': '\[\d\d\.\d\d\.\d\d\,\ \d\d:\d\d:\d\d\] ',
-                   'iphone2': '\[\d+\/\d+\/\d\d \d+:\d+:\d+\] ',
-                   'android': '\\d\\d\\.\\d\\d\\.\\d\\d, \\d\\d:\\d\\d - ',}
-        
-        timestamp_formats = {'iphone': '\d\d\.\d\d\.\d\d\,\ \d\d:\d\d:\d\d',
-                             'iphone2': '\d+\/\d+\/\d\d \d+:\d+:\d+',
-                             'android': '\\d\\d\\.\\d\\d\\.\\d\\d, \\d\\d:\\d\\d'}     
-        
-        timeconversion_formats = {'iphone': '%d.%m.%y, %H:%M:%S',
-                                  'iphone2': '%d/%m/%y %H:%M:%S',
-                                  'android': '%d.%m.%y, %H:%M'}
-        
-        # extract the format of a given message
-        def extract_format(message_string):
-            for f, string in formats.items():
-                if bool(re.search(string, message_string)):
-                    return(f)
-                   
+        # Format detection: the first lines are matched against the prefixes
+        # of all registered formats (see chat_formats). The parse loop then
+        # only uses the prefix regex and timestamp decoder of the detected 
+        # format.
+        chat_format = detect_format(first_lines)
+        self.format = chat_format.name
+        prefix_match = chat_format.prefix.match
+        
+        def parse(chat):
+            
+            # Delete messages which contain some of the strings in exclude
+            chat = (message for message in chat 
+                    if not any(string in message for string in exclude))
+          
+            # Initialize a list for every column
+            timestamps = list()
+            messages = list() 
+            writtenby = list()
+            
+            for s in chat: 
+                match = prefix_match(s)
+                if match is None and s[:1] in ('\u200e', '\ufeff'):
+                    # Some exports mark lines with invisible characters
+                    s = s.lstrip('\u200e\ufeff')
+                    match = prefix_match(s)
+                if match is not None:
+                    after_format = s[match.end():]
                     
-        # checks if the format of the first x messages is equal 
-        def format_consistency_check(messages):
-            found_formats = list() 
-            for i in range(len(messages)):
-                
-                # If newline in one message than no format will be found.
-                # So here will be checked if the first char is a letter and 
-                # if yes, the loop skips this. 
-                if not bool(re.search('[A-Z, a-z]', messages[i][0])):
-                    found_formats.append(extract_format(messages[i]))
-            found_formats = [el for el in found_formats if el is not None]
-            if any([len(np.unique(found_formats)) > 1,
-                    len(np.unique(found_formats)) < 1]):
-                raise ValueError('The provided chat format is not known yet.')
-            return np.unique(found_formats)[0]  
-        
-        # Finally append the format attribute to the object
-        format_ = format_consistency_check(chat[0:10])
-        self.format = format_
-        
-        # Delete messages which contain some of the strings in exclude
-        for string in exclude:
-            chat = [message for message in chat if string not in message]
-      
-        # Initialize a list for every column
+                    # If the ":" not in a message than the message is from 
+                    # whatsapp ifself like "xx has left the group"
+                    if ':' not in after_format:
+                        continue
+                    who, _, message = after_format.partition(':')
+                    if message.startswith(' '):
+                        message = message[1:]
+                    writtenby.append(who)
+                    timestamps.append(match.group('timestamp'))
+                    messages.append(message)
+                elif len(messages) > 0: 
+                    # concat parts of messages split by newline into one 
+                    # message. This happens when doing .split('/n') after 
+                    # reading the file
+                    messages[-1] = messages[-1] + ' ' + s 
+            return timestamps, writtenby, messages
+        
         timestamps = list()
-        messages = list() 
         writtenby = list()
+        messages = list()
+        chunk_numbers = list()
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                # Sampled chunks start somewhere in the file, skip the lines 
+                # before the first complete message
+                starts = [prefix_match(l) is not None for l in chunk]
+                chunk = chunk[starts.index(True):] if any(starts) else []
+            parsed = parse(chunk)
+            timestamps.extend(parsed[0])
+            writtenby.extend(parsed[1])
+            messages.extend(parsed[2])
+            chunk_numbers.extend([i] * len(parsed[0]))
         
-        for i, s in enumerate(chat): 
-            timestamp = re.search(timestamp_formats[format_], s)
-            if (len(s) > 0) & (bool(timestamp)):
-                
-                after_format = re.split(formats[format_], s)[1]
-                
-                # If the ":" not in a message than the message is from whatsapp
-                # ifself like "xx has left the group"
-                if ':' not in after_format:
-                    continue
-                else:
-                    who = after_format.split(':')[0]
-                    writtenby.append(who)
-                
-                timestamp = timestamp.group(0)
-                timestamps.append(timestamp)
-                s = re.sub(formats[format_], '', s)
-                s = re.sub(who + ': ', '', s)
-                messages.append(s)
-            else: 
-                # concat parts of messages split by newline into one message.
-                # This happens when doing .split('/n') after reading the file
-                messages[-1] = messages[-1] + ' ' + s 
-        
-        timestamps = pd.to_datetime(timestamps, 
-                                    format = timeconversion_formats[format_])
+        chat_format, timestamps = decode_timestamps(chat_format, timestamps)
+        self.format = chat_format.name
         
         # Finally the table
         table = pd.DataFrame({'Timestamp': timestamps, 
                               'Written_by': writtenby, 
                               'Message': messages})
+        if sample_fraction is not None:
+            table['Chunk'] = chunk_numbers
         table.dropna(inplace=True)
         table = table.loc[table['Written_by'] != 'Sender not detected']
         return table
 
+    
+    @staticmethod
+    def is_compressed(path):
+        return path.lower().endswith(('.zip', '.gz'))
+    
+    
+    @staticmethod
+    def open_chat(path):
+        '''
+        Opens a chat as text stream. A .zip file (as produced by the 
+        "Export chat" function) is searched for the chat text file, which 
+        is preferably named _chat.txt, and a .gz file is assumed to contain
+        the text itself. Both are decompressed on the fly while reading.
+        '''
+        lower = path.lower()
+        if lower.endswith('.zip'):
+            archive = zipfile.ZipFile(path)
+            members = [m for m in archive.namelist() if m.endswith('.txt')]
+            chat_members = [m for m in members if m.endswith('_chat.txt')]
+            if len(members) == 0:
+                archive.close()
+                raise ValueError('No chat text file found in ' + path)
+            member = (chat_members + members)[0]
+            return io.TextIOWrapper(archive.open(member), encoding='utf-8')
+        elif lower.endswith('.gz'):
+            return gzip.open(path, 'rt', encoding='utf-8')
+        return open(path, encoding='utf-8')
+    
+    
+    def read_chat_lines(self, path):
+        '''
+        Generator over the lines of a chat (without line breaks). The file 
+        is read in buffered blocks, never as a whole.
+        '''
+        with self.open_chat(path) as file:
+            for line in file:
+                yield line.rstrip('\n')
+    
+    
+    def read_sample(self, path, sample_fraction, n_chunks=preview_chunks):
+        '''
+        Reads n_chunks evenly spaced byte ranges which together cover about 
+        sample_fraction of the file. The first chunk always starts at the 
+        beginning of the file. Incomplete lines at the borders of a chunk 
+        are dropped.
+        
+        Returns: List of chunks, each a list of lines. Sets the attributes 
+        sample_fraction (the fraction actually read) and sample_population 
+        (the number of chunks of this size the file consists of).
+        '''
+        size = os.path.getsize(path)
+        chunk_size = max(int(size * sample_fraction / n_chunks), 1)
+        if sample_fraction >= 1 or chunk_size * n_chunks >= size or \
+                self.is_compressed(path):
+            # Compressed files can't be read at arbitrary offsets
+            chunks = [list(self.read_chat_lines(path))]
+            self.sample_fraction = 1.0
+            self.sample_population = 1
+            return chunks
+        
+        chunks = list()
+        with open(path, 'rb') as file:
+            for start in np.linspace(0, size - chunk_size, n_chunks):
+                file.seek(int(start))
+                data = file.read(chunk_size)
+                lines = data.decode('utf-8', errors='ignore').split('\n')
+                if start > 0:
+                    lines = lines[1:]
+                chunks.append(lines[:-1])
+        self.sample_fraction = chunk_size * n_chunks / size
+        self.sample_population = size / chunk_size
+        return chunks
+    
     ########################################################################
     # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~# 
     # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~# 
@@ -190,7 +397,7 @@ class Whatsapp_Analytics():
             message_sizes = message_sizes['Wordlengths']
             layout['title'] = 'Distribution of message lengths in words'
         else:
-            message_sizes = message_sizes['Charlenghts']
+            message_sizes = message_sizes['Charlengths']
             layout['title'] = 'Distribution of message lengths in characters'
           
         maxs = list()
@@ -200,9 +407,10 @@ class Whatsapp_Analytics():
         bins = dict(start=0, end=xmax, size=xmax/30)    
         
         traces = list()
-        for i, key in enumerate(message_sizes.keys()):
-            hist = go.Histogram(x=message_sizes[key], name=key, xbins=bins,
-                                marker=dict(color=self.colors[i]))
+        for label, names, color in self.trace_groups():
+            sizes = np.concatenate([message_sizes[n] for n in names])
+            hist = go.Histogram(x=sizes, name=label, xbins=bins,
+                                marker=dict(color=color))
             traces.append(hist)
     
         if only_trace:
@@ -223,20 +431,22 @@ class Whatsapp_Analytics():
         resptimes = self.calc_respond_time()['All_messages']
         layout = copy(self.plot_theme)
         if tail:
-            maxs = list()
-            for key in resptimes.keys():
-                maxs.append(np.max(resptimes[key]))
-            xmax = np.max(maxs)
-            bins =dict(start=30, size=xmax/30)
+            # Participants who never replied have no respond times, a chat
+            # without replies has none at all
+            maxs = [np.max(times) for times in resptimes.values() 
+                    if len(times) > 0]
+            xmax = np.max(maxs) if len(maxs) > 0 else 0
+            bins =dict(start=30, size=xmax/30 if xmax > 0 else 1)
             layout['title'] = 'Distribution of long time respond time in minutes'
         else: 
             bins = dict(start=0, end=30, size=1)
             layout['title'] = 'Distribution of short time respond time in minutes'
         
         traces = list()
-        for i, key in enumerate(resptimes.keys()):
-            hist = go.Histogram(x=resptimes[key], xbins=bins, name=key,
-                                marker=dict(color=self.colors[i]))
+        for label, names, color in self.trace_groups():
+            times = np.concatenate([resptimes[n] for n in names])
+            hist = go.Histogram(x=times, xbins=bins, name=label,
+                                marker=dict(color=color))
             traces.append(hist)
         
         if only_trace:
@@ -250,21 +460,14 @@ class Whatsapp_Analytics():
     def plot_intraday_active_time(self, min_step=60, nb_mode=False, 
                                   only_trace = False):
         
-        def convert(date):
-            date = datetime(date.year, date.month, date.day, 
-                            date.hour, min_step*(date.minute // min_step))
-            return date.time()
-        
+        counts = self.calc_time_of_day_counts(min_step)
+        labels = ['%02d:%02d' % divmod(m, 60) 
+                  for m in range(0, 24 * 60, min_step)]
         traces = list()
-        for i, table in enumerate(self.tables):
-            table_copy = table.copy(deep=True)
-            table_copy['Timestamp'] = table_copy['Timestamp'].apply(convert)
-            name = table_copy['Written_by'].iloc[0]
-            hist = go.Histogram(x=np.sort(table_copy['Timestamp']), 
-                                name = name, 
-                                marker=dict(color=self.colors[i]))
-            traces.append(hist)
-            del table_copy
+        for label, names, color in self.trace_groups():
+            y = counts[self.name_codes(names)].sum(axis=0)
+            bar = go.Bar(x=labels, y=y, name=label, marker=dict(color=color))
+            traces.append(bar)
  
         layout = copy(self.plot_theme)
         layout['title'] = 'Distribution of messages during the day'
@@ -278,27 +481,7 @@ class Whatsapp_Analytics():
     
     def plot_wordcloud(self, who='all', nb_mode=False):
         
-        if who == 'all':
-            df = self.df
-        else:
-            try:
-                df = self.df.loc[self.df['Written_by'] == who, :]
-            except ValueError:
-                print('The name you entered does not occur in the chat.'
-                      'Check .names attribute to see all possibe names')
-                
-        text = ' '.join(df['Message']).lower()
-        stopwords = get_stop_words(self.languages[0])
-        if len(self.languages) > 1:
-            for i in range(1, len(self.languages)):
-                stopwords.extend(get_stop_words(self.languages[i]))
-        if self.theme == 'dark':
-            background = 'black'
-        elif self.theme == 'light':
-            background = 'white'
-        wc = WordCloud(stopwords=stopwords, width=1500, height=1500,
-                       max_words=400, scale=1, background_color=background)
-        wc.generate(text)
+        wc = self.calc_wordcloud(who)
         plt.figure(figsize=(16,12))
         plt.imshow(wc, interpolation='bilinear')
         plt.axis("off")
@@ -312,29 +495,19 @@ class Whatsapp_Analytics():
     
     def plot_dist_of_weekdays(self, nb_mode=False, only_trace=False):
          
+        counts = self.calc_weekday_hour_counts().sum(axis=2)
         traces = list()
-        weekdays = {'1': 'Monday', 
-                    '2': 'Tuesdays', 
-                    '3': 'Wednesday', 
-                    '4': 'Thursday', 
-                    '5': 'Friday',
-                    '6': 'Saturday', 
-                    '7': 'Sunday'}
-        for i in range(len(self.names)):
-            t = self.tables[i].copy(deep=True)
-            t['Timestamp'] = [x.isoweekday() for x in t['Timestamp']]
-            t['Timestamp'] = t['Timestamp'].apply(str).replace(weekdays)
-            grouped = t.groupby('Timestamp').size()
-            bar = go.Bar(x=grouped.index, y=grouped, name=self.names[i],
-                         marker=dict(color=self.colors[i]))
+        for label, names, color in self.trace_groups():
+            y = counts[self.name_codes(names)].sum(axis=0)
+            bar = go.Bar(x=self.weekdays, y=y, name=label,
+                         marker=dict(color=color))
             traces.append(bar)
           
         layout = copy(self.plot_theme)
         layout['title'] = 'Distribution of sent messages over weekdays'
         layout['xaxis'] = {
             'categoryorder': 'array',
-            'categoryarray': [x for _, x in sorted(zip(weekdays.keys(), 
-                                                       weekdays.values()))]
+            'categoryarray': self.weekdays
         }
         if only_trace:
             return traces, layout
@@ -344,26 +517,58 @@ class Whatsapp_Analytics():
         plot(fig)
         
     
+    def plot_weekday_hour_heatmap(self, who='all', nb_mode=False, 
+                                  only_trace=False):
+        '''
+        Heatmap of the number of messages per weekday and hour of the day.
+        
+        Args:
+        - who: "all" for the whole chat or the name of a participant
+        '''
+        
+        counts = self.calc_weekday_hour_counts()
+        if who == 'all':
+            values = counts.sum(axis=0)
+        elif who in self.names:
+            values = counts[self.name_codes([who])[0]]
+        else:
+            raise ValueError('The name you entered does not occur in the '
+                             'chat. Check .names attribute to see all '
+                             'possible names')
+        
+        heat = go.Heatmap(z=values, x=['%02d:00' % h for h in range(24)],
+                          y=self.weekdays, colorscale='Viridis')
+        traces = [heat]
+        layout = copy(self.plot_theme)
+        layout['title'] = 'Messages per weekday and hour of ' + who
+        layout['yaxis'] = {'autorange': 'reversed'}
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+        
+    
     def plot_most_used_emojis(self, nb_mode=False, only_trace=False):
     
-        freqs = list()
-        names = list()
-        for table in self.tables:
-            smilies = self.extract_emojis(table['Message'])
-            freqs.append(pd.Series(smilies).value_counts())
-            names.append(table['Written_by'].iloc[0])
+        counts = self.calc_emoji_counts()
+        groups = self.trace_groups()
+        freqs = pd.concat([counts[names].sum(axis=1) 
+                           for label, names, color in groups], 
+                          axis=1, sort=True)
             
         # the following is done to sort the emojis by sum of usage of all 
         # persons in the chat
-        freqs = pd.concat(freqs, axis=1, sort=True).fillna(0)
         freqs["sum"] = freqs.apply(sum, axis=1)
         freqs.sort_values(by="sum", inplace=True, ascending=False)
         freqs = freqs.iloc[1:15, :]
         freqs.drop(["sum"], inplace=True, axis=1)
         traces = list()
         for i in range(freqs.shape[1]):
-            bar = go.Bar(x=freqs.index, y=freqs.iloc[:, i], name=names[i],
-                         marker=dict(color=self.colors[i]))
+            bar = go.Bar(x=freqs.index, y=freqs.iloc[:, i], 
+                         name=groups[i][0],
+                         marker=dict(color=groups[i][2]))
             traces.append(bar)
         layout = copy(self.plot_theme)
         layout['title'] = 'Most used emojis'
@@ -377,35 +582,37 @@ class Whatsapp_Analytics():
 
     def plot_overall_participition(self, nb_mode=False, only_trace=False):
         
-        days = self.df['Timestamp'].copy(deep=True)
-        days = np.unique([x.date() for x in days])
+        daily = self.calc_daily_counts()['Counts']
+        n_days = np.count_nonzero(daily.sum(axis=0))
         perc_mes = list()
         perc_days = list()
-        for i in range(len(self.names)):
-            tab = self.tables[i].copy(deep=True)
-            perc_mes.append(tab.shape[0] / self.df.shape[0])
-            days_person = [x.date() for x in tab['Timestamp']]
-            perc_days.append(len(np.unique(days_person)) / len(days))
+        groups = self.trace_groups()
+        for label, names, color in groups:
+            counts = daily[self.name_codes(names)]
+            perc_mes.append(counts.sum() / self.df.shape[0])
+            perc_days.append(np.count_nonzero(counts.sum(axis=0)) / n_days)
+        labels = [g[0] for g in groups]
+        colors = [g[2] for g in groups]
         
         pie1 = {
             'values': perc_mes,
-            'labels': self.names,
+            'labels': labels,
             'domain': {'x': [0, .48]},
             'hoverinfo':'label+percent+name',
             'hole': .4,
             'type': 'pie',
             'name': 'Percentage of messages sent',
-            'marker': dict(colors=self.colors)
+            'marker': dict(colors=colors)
             }
         pie2 = { 
             'values': perc_days,
-            'labels': self.names,
+            'labels': labels,
             "domain": {"x": [.52, 1]},
             'hoverinfo':'label+percent+name',
             'hole': .4,
             'type': 'pie',
             'name': 'Percentage of days of participation',
-            'marker': dict(colors=self.colors)
+            'marker': dict(colors=colors)
             }
 
         layout = copy(self.plot_theme)
@@ -438,21 +645,231 @@ class Whatsapp_Analytics():
         plot(fig)
 
 
-    def plot_chronology(self, nb_mode=False, only_trace=False):
+    def plot_chronology(self, nb_mode=False, only_trace=False, 
+                        resolution='auto', x_range=None, max_points=None):
+        '''
+        Number of messages sent over time, rendered with WebGL so that long
+        chats with many participants stay responsive.
         
-        traces = list()
+        Args:
+        - resolution: One of "day", "week", "month" or "auto". With "auto"
+          the finest resolution is chosen which shows at most 
+          chronology_max_buckets points (see config) in the visible range.
+        - x_range: Tuple of two dates. Only this window is aggregated and 
+          shown. Used by the Dash app to re-aggregate when zooming.
+        - max_points: If given, every trace is downsampled with the 
+          largest-triangle-three-buckets algorithm to at most this many
+          points.
+        '''
         
-        for i in range(len(self.names)):
-            t = self.tables[i].copy(deep=True)
-            t.Timestamp = [x.date() for x in t.Timestamp]
-            grouped = t.groupby('Timestamp').size()
-            scat = go.Scatter(x=grouped.index, y=grouped, mode='lines+markers', 
-                              name=self.names[i], 
-                              marker=dict(color=self.colors[i]))
+        chronology = self.calc_chronology(resolution=resolution, 
+                                          x_range=x_range)
+        traces = list()
+        for label, names, color in self.trace_groups():
+            x = chronology['Dates']
+            y = chronology['Counts'][self.name_codes(names)].sum(axis=0)
+            if max_points is not None:
+                ind = self.lttb_indices(y, max_points)
+                x, y = x[ind], y[ind]
+            scat = go.Scattergl(x=x, y=y, mode='lines+markers', 
+                                name=label, 
+                                marker=dict(color=color))
             traces.append(scat)
 
         layout = copy(self.plot_theme)
-        layout['title'] = 'Number of messages sent over time'
+        layout['title'] = 'Number of messages sent per ' + \
+            chronology['Resolution'] + ' over time'
+        if x_range is not None:
+            layout['xaxis'] = {'range': [str(x) for x in x_range]}
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+    
+    
+    def plot_rolling_average(self, window=30, nb_mode=False, 
+                             only_trace=False):
+        '''
+        Moving average of the number of messages per day over the last
+        window days.
+        '''
+        
+        days = self.calc_daily_counts()['Days']
+        sums = self.calc_rolling_sums(window)
+        divisor = np.minimum(np.arange(1, len(days) + 1), window)
+        traces = list()
+        for label, names, color in self.trace_groups():
+            y = sums[self.name_codes(names)].sum(axis=0) / divisor
+            scat = go.Scattergl(x=days, y=y, mode='lines', name=label,
+                                marker=dict(color=color))
+            traces.append(scat)
+        
+        layout = copy(self.plot_theme)
+        layout['title'] = ('Number of messages per day, moving average '
+                           'over ' + str(window) + ' days')
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+    
+    
+    def plot_share_over_time(self, window=90, nb_mode=False, 
+                             only_trace=False):
+        '''
+        Percentage of messages sent by every participant within the last
+        window days.
+        '''
+        
+        days = self.calc_daily_counts()['Days']
+        sums = self.calc_rolling_sums(window)
+        total = sums.sum(axis=0).astype('float64')
+        total[total == 0] = np.nan
+        traces = list()
+        for label, names, color in self.trace_groups():
+            y = 100 * sums[self.name_codes(names)].sum(axis=0) / total
+            scat = go.Scattergl(x=days, y=y, mode='lines', name=label,
+                                marker=dict(color=color))
+            traces.append(scat)
+        
+        layout = copy(self.plot_theme)
+        layout['title'] = ('Percentage of messages sent within the last ' + 
+                           str(window) + ' days')
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+    
+    
+    def plot_cumulative_messages(self, nb_mode=False, only_trace=False):
+        
+        days = self.calc_daily_counts()['Days']
+        cumulative = self.calc_cumulative_counts()[:, 1:]
+        traces = list()
+        for label, names, color in self.trace_groups():
+            y = cumulative[self.name_codes(names)].sum(axis=0)
+            scat = go.Scattergl(x=days, y=y, mode='lines', name=label,
+                                marker=dict(color=color))
+            traces.append(scat)
+        
+        layout = copy(self.plot_theme)
+        layout['title'] = 'Total number of messages sent over time'
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+    
+    
+    def plot_term_usage(self, term, resolution='auto', nb_mode=False, 
+                        only_trace=False):
+        '''
+        Number of messages containing term over time. With several words
+        in term, messages containing all of them are counted.
+        '''
+        
+        usage = self.calc_term_usage(term, resolution=resolution)
+        traces = list()
+        for label, names, color in self.trace_groups():
+            y = usage['Counts'][self.name_codes(names)].sum(axis=0)
+            scat = go.Scattergl(x=usage['Dates'], y=y, mode='lines+markers',
+                                name=label, marker=dict(color=color))
+            traces.append(scat)
+        
+        layout = copy(self.plot_theme)
+        layout['title'] = ('Number of messages per ' + usage['Resolution'] + 
+                           ' containing "' + term + '"')
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+    
+    
+    def plot_session_starters(self, gap_minutes=session_gap_minutes,
+                              nb_mode=False, only_trace=False):
+        
+        sessions = self.calc_sessions(gap_minutes)
+        traces = list()
+        for label, names, color in self.trace_groups():
+            y = [sessions['Started'][names].sum(), 
+                 sessions['Ended'][names].sum(),
+                 sessions['Participated'][names].sum()]
+            bar = go.Bar(x=['Started', 'Ended', 'Participated'], y=y, 
+                         name=label, marker=dict(color=color))
+            traces.append(bar)
+            
+        layout = copy(self.plot_theme)
+        layout['title'] = ('Number of conversations started, ended and '
+                           'participated in')
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+        
+    
+    def plot_dist_of_session_length(self, gap_minutes=session_gap_minutes,
+                                    nb_mode=False, only_trace=False):
+        
+        sessions = self.calc_sessions(gap_minutes)['Sessions']
+        traces = list()
+        for label, names, color in self.trace_groups():
+            started = sessions.loc[sessions['Started_by'].isin(names), :]
+            hist = go.Histogram(x=started['Number_messages'], name=label,
+                                marker=dict(color=color))
+            traces.append(hist)
+        
+        layout = copy(self.plot_theme)
+        layout['title'] = ('Distribution of number of messages per '
+                           'conversation by starter')
+        layout['barmode'] = 'stack'
+        if only_trace:
+            return traces, layout
+        fig = go.Figure(data=traces, layout=layout)
+        if nb_mode:
+            return fig
+        plot(fig)
+    
+    
+    def plot_interaction_heatmap(self, median_time=False, top=30, 
+                                 nb_mode=False, only_trace=False):
+        '''
+        Heatmap of who replies to whom. Rows are the repliers, columns the 
+        persons they replied to. 
+        
+        Args:
+        - median_time: If True, show the median reply time in minutes 
+          instead of the number of replies.
+        - top: Only the top participants (by replies sent and received) 
+          are shown to keep the plot readable in large groups.
+        '''
+        
+        matrices = self.calc_interaction_matrix(top=top)
+        shown = matrices['Counts'].index
+        if median_time:
+            values = matrices['Median_reply_time']
+            title = 'Median reply time (minutes) of row to column'
+        else:
+            values = matrices['Counts']
+            title = 'Number of replies of row to column'
+        
+        heat = go.Heatmap(z=values.values, x=list(shown), y=list(shown),
+                          colorscale='Viridis')
+        traces = [heat]
+        layout = copy(self.plot_theme)
+        layout['title'] = title
+        layout['xaxis'] = {'title': 'Replied to', 'type': 'category'}
+        layout['yaxis'] = {'title': 'Replier', 'type': 'category', 
+                           'autorange': 'reversed'}
         if only_trace:
             return traces, layout
         fig = go.Figure(data=traces, layout=layout)
@@ -473,35 +890,30 @@ class Whatsapp_Analytics():
         
         # These plots don't work properly within a subplot and will be excluded
         not_working = ['plot_wordcloud', 'plot_overall_participition',
-                       'plot_all_possible_plots']
+                       'plot_all_possible_plots', 'plot_interaction_heatmap',
+                       'plot_theme', 'plot_term_usage']
         
         # Find all plot methods in this object which are not included in the
         # "not-working" ones.
         plots = [m for m in dir(self) if 'plot_' in m and m not in not_working]
-        color_strings = self.colors
-        
-        traces_list = list()
-        layout_list = list()
-        titles = list()
         
-        for i, method in enumerate(plots):
-            traces, layout = getattr(self, method)(only_trace=True)
-            traces_list.append(traces)
-            layout_list.append(layout)
-            titles.append(layout['title'])
+        # The traces of all plots are computed concurrently
+        figures = self.calc_overview([(method, {}) for method in plots])
+        traces_list = [traces for traces, layout in figures]
+        titles = [layout['title'] for traces, layout in figures]
             
         fig = tools.make_subplots(rows=len(plots), cols=1,
                                   subplot_titles = titles)
         
+        # Only the traces of the first plot are shown in the legend
+        all_traces = list()
+        rows = list()
         for i, traces in enumerate(traces_list):
-            if i == 0:
-                sl = True
-            else:
-                sl = False
-            for j, trace in enumerate(traces):
-                trace['showlegend'] = sl
-                trace['marker'] = dict(color = color_strings[j])
-                fig.append_trace(trace, i + 1, 1)
+            for trace in traces:
+                trace['showlegend'] = i == 0
+                all_traces.append(trace)
+                rows.append(i + 1)
+        fig.add_traces(all_traces, rows=rows, cols=[1] * len(rows))
                 
         fig['layout'].update(
         font=self.plot_theme['font'],
@@ -545,7 +957,7 @@ class Whatsapp_Analytics():
             os.makedirs(directory)
         
         not_working = ['plot_wordcloud',
-               'plot_all_possible_plots', 'plot_theme']
+               'plot_all_possible_plots', 'plot_theme', 'plot_term_usage']
         plots = [m for m in dir(self) if 'plot_' in m and m not in not_working]
         for method in plots:
             p = getattr(self, method)(nb_mode=True)
@@ -570,11 +982,8 @@ class Whatsapp_Analytics():
         restable = self.show_summary_statistics()
         for stuff in restable.index:
             tmp = restable.loc[stuff, :]
-            traces = list()
-            for name, color in zip(self.names, self.colors):
-                bar = go.Bar(x = [name], y=[tmp[name]], name=name, 
-                             marker=dict(color=color))
-                traces.append(bar)
+            traces = [go.Bar(x=self.names, y=tmp[self.names], 
+                             marker=dict(color=self.colors))]
             layout = copy(self.plot_theme)
             layout['title'] = stuff
             fig = go.Figure(traces, layout = layout)
@@ -583,6 +992,41 @@ class Whatsapp_Analytics():
         if verbose:
             print("Summary statistic plots ready.")
 
+
+    def save_report(self, path=os.getcwd() + "/report.html",
+                    include_plotlyjs=True):
+        '''
+        Saves all plots and the summary statistics into a single html page.
+        In contrast to calling every plot method, plotly.js is included only
+        once and every figure is drawn when it is scrolled into view.
+        Histograms are stored as their bin counts and long time series are
+        downsampled, so the size of the report doesn't grow with the number 
+        of messages. The wordclouds are not
+        included, use save_all_results for them.
+
+        Args:
+        - path: Path of the html file
+        - include_plotlyjs: True to embed plotly.js, such that the report
+          also works offline, or "cdn" to load it from the internet, which
+          keeps the report a few hundred KB small.
+
+        Returns: The path of the report
+        '''
+
+        figures = [(self.downsample_traces(traces), layout) 
+                   for traces, layout in self.calc_overview()]
+
+        summary = self.show_summary_statistics().to_html()
+        html = render_report(
+            'Whatsapp analytics of ' + os.path.basename(self.path), figures,
+            summary=summary, include_plotlyjs=include_plotlyjs,
+            background=self.plot_theme['paper_bgcolor'],
+            color=self.plot_theme['font']['color'],
+            height=self.plot_theme['height'])
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(html)
+        return path
+
     ########################################################################
     # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~# 
     # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~# 
@@ -592,48 +1036,742 @@ class Whatsapp_Analytics():
     ########################################################################
     
     def calc_number_messages_per_day(self):
+        '''
+        Number of messages of every participant on every day with at least
+        one message of this participant.
+        
+        Returns: dict of Series indexed by date
+        '''
+        daily = self.calc_daily_counts()
         num_mes_dict = {}
-        for i, table in enumerate(self.tables):
-            name = table['Written_by'].iloc[0]
-            copy = table.copy(deep=True)
-            copy['day'] = [stamp.date() for stamp in copy.Timestamp] 
-            sizes = pd.Series(copy.groupby('day').size())
-            num_mes_dict[name] = sizes
+        for name, counts in zip(self.names, daily['Counts']):
+            active = counts > 0
+            num_mes_dict[name] = pd.Series(
+                counts[active].astype('int64'), 
+                index=daily['Days'][active].astype(object))
         return num_mes_dict
     
     
+    def calc_daily_counts(self):
+        '''
+        Dense number of messages per participant and calendar day, 
+        including the days without any message. 
+        
+        Returns: dict with
+            - Days: datetime64[D] array of all days from the first to the 
+              last message
+            - Counts: Array of shape (participants, days), rows ordered 
+              like self.names
+        '''
+        if 'daily_counts' in self._cache:
+            return self._cache['daily_counts']
+        
+        cube = self.calc_aggregate_cube()
+        result = {'Days': cube.days,
+                  'Counts': cube.reduce('messages', ('participant', 'day'))
+                  .astype('int32')}
+        self._cache['daily_counts'] = result
+        return result
+    
+    
+    def calc_aggregate_cube(self):
+        '''
+        The Aggregate_Cube of messages, words and characters per 
+        participant, day and hour. Like the search index it is saved next 
+        to the chat file and loaded from there as long as the chat didn't
+        change.
+        '''
+        if 'aggregate_cube' in self._cache:
+            return self._cache['aggregate_cube']
+        
+        cube = None
+        cube_path = None
+        if self.path is not None and os.path.exists(self.path) and \
+                self.sample_fraction == 1:
+            cube_path = Aggregate_Cube.path_for(self.path)
+            if os.path.exists(cube_path) and \
+                    os.path.getmtime(cube_path) >= os.path.getmtime(self.path):
+                cube = Aggregate_Cube.load(cube_path)
+                if cube.n_messages != self.df.shape[0] or \
+                        cube.names != self.names:
+                    cube = None
+        if cube is None:
+            words, chars = self.calc_message_lengths()
+            cube = Aggregate_Cube.build(self.names, self.calc_writer_codes(),
+                                        self.df['Timestamp'].values, 
+                                        words, chars)
+            if cube_path is not None:
+                try:
+                    cube.save(cube_path)
+                except OSError:
+                    pass
+        self._cache['aggregate_cube'] = cube
+        return cube
+    
+    
+    def calc_cumulative_counts(self):
+        '''
+        Cumulative sums of calc_daily_counts along the days with a leading
+        column of zeros, so that the number of messages between day i 
+        (inclusive) and day j (exclusive) is column j minus column i.
+        
+        Returns: Array of shape (participants, days + 1)
+        '''
+        if 'cumulative_counts' not in self._cache:
+            counts = self.calc_daily_counts()['Counts']
+            cumulative = np.zeros((counts.shape[0], counts.shape[1] + 1), 
+                                  dtype='int64')
+            np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+            self._cache['cumulative_counts'] = cumulative
+        return self._cache['cumulative_counts']
+    
+    
+    def calc_rolling_sums(self, window):
+        '''
+        Number of messages per participant within the last window days 
+        (including the day itself) for every day of the chat. Costs one 
+        subtraction of two slices of calc_cumulative_counts.
+        
+        Returns: Array of shape (participants, days)
+        '''
+        cumulative = self.calc_cumulative_counts()
+        n_days = cumulative.shape[1] - 1
+        ends = np.arange(1, n_days + 1)
+        starts = np.maximum(ends - window, 0)
+        return cumulative[:, ends] - cumulative[:, starts]
+    
+    
+    def calc_rolling_messages(self, window=7):
+        '''
+        Moving average of the number of messages per day over the last 
+        window days. The first days of the chat are averaged over the 
+        days available so far.
+        
+        Returns: DataFrame with one row per calendar day and one column 
+        per participant
+        '''
+        days = self.calc_daily_counts()['Days']
+        divisor = np.minimum(np.arange(1, len(days) + 1), window)
+        averages = self.calc_rolling_sums(window) / divisor
+        return pd.DataFrame(averages.T, index=days, columns=self.names)
+    
+    
+    def calc_share_over_time(self, window=30):
+        '''
+        Fraction of the messages within the last window days which were 
+        sent by each participant. Days without any message in the window 
+        are NaN.
+        
+        Returns: DataFrame with one row per calendar day and one column 
+        per participant
+        '''
+        days = self.calc_daily_counts()['Days']
+        sums = self.calc_rolling_sums(window)
+        total = sums.sum(axis=0).astype('float64')
+        total[total == 0] = np.nan
+        return pd.DataFrame((sums / total).T, index=days, columns=self.names)
+    
+    
+    def calc_cumulative_messages(self):
+        '''
+        Total number of messages sent up to and including every calendar 
+        day.
+        
+        Returns: DataFrame with one row per calendar day and one column 
+        per participant
+        '''
+        days = self.calc_daily_counts()['Days']
+        cumulative = self.calc_cumulative_counts()[:, 1:]
+        return pd.DataFrame(cumulative.T, index=days, columns=self.names)
+    
+    
+    def calc_chronology(self, resolution='auto', x_range=None):
+        '''
+        Aggregates the daily counts of calc_daily_counts to days, weeks 
+        (starting on monday) or months. Only the days within x_range are 
+        touched, so zooming into a window costs time proportional to the 
+        window and not to the whole chat.
+        
+        Returns: dict with Dates (start of every bucket), Counts (array of 
+        shape (participants, buckets)) and the used Resolution.
+        '''
+        daily = self.calc_daily_counts()
+        days = daily['Days']
+        lo, hi = 0, len(days)
+        if x_range is not None:
+            start = np.datetime64(pd.Timestamp(x_range[0]).date(), 'D')
+            end = np.datetime64(pd.Timestamp(x_range[1]).date(), 'D')
+            lo, hi = np.searchsorted(days, [start, end + 1])
+            lo, hi = min(lo, len(days) - 1), max(hi, lo + 1)
+        return self.bucket_daily_counts(days[lo:hi], 
+                                        daily['Counts'][:, lo:hi], resolution)
+    
+    
+    @staticmethod
+    def bucket_daily_counts(days, counts, resolution='auto'):
+        '''
+        Sums the columns of counts, which belong to the consecutive 
+        calendar days in days, up to days, weeks or months. See 
+        calc_chronology.
+        '''
+        window = days
+        if resolution == 'auto':
+            if len(window) <= chronology_max_buckets:
+                resolution = 'day'
+            elif len(window) / 7 <= chronology_max_buckets:
+                resolution = 'week'
+            else:
+                resolution = 'month'
+        
+        if resolution == 'day':
+            return {'Dates': window, 'Counts': counts, 
+                    'Resolution': resolution}
+        elif resolution == 'week':
+            # 1970-01-01 was a thursday, shift by 3 days to start on monday
+            keys = (window.astype('int64') + 3) // 7
+            labels = (keys * 7 - 3).astype('datetime64[D]')
+        elif resolution == 'month':
+            keys = window.astype('datetime64[M]')
+            labels = keys.astype('datetime64[D]')
+        else:
+            raise ValueError('resolution must be "auto", "day", "week" or '
+                             '"month"')
+        
+        starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+        counts = np.add.reduceat(counts, starts, axis=1)
+        return {'Dates': labels[starts], 'Counts': counts, 
+                'Resolution': resolution}
+    
+    
+    @staticmethod
+    def lttb_indices(y, n_out):
+        '''
+        Largest-triangle-three-buckets downsampling of an evenly spaced 
+        series. Returns the indices of at most n_out points of y which keep
+        the visual shape of the series (peaks are preserved).
+        '''
+        y = np.asarray(y, dtype='float64')
+        n = len(y)
+        if n_out >= n or n_out < 3:
+            return np.arange(n)
+        
+        edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+        x = np.arange(n, dtype='float64')
+        indices = [0]
+        a = 0
+        for i in range(n_out - 2):
+            lo, hi = edges[i], edges[i + 1]
+            if i + 2 < len(edges):
+                next_x = x[hi:edges[i + 2]].mean()
+                next_y = y[hi:edges[i + 2]].mean()
+            else:
+                next_x, next_y = x[-1], y[-1]
+            area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - 
+                          (x[a] - x[lo:hi]) * (next_y - y[a]))
+            a = lo + int(np.argmax(area))
+            indices.append(a)
+        indices.append(n - 1)
+        return np.array(indices)
+    
+    
+    def downsample_traces(self, traces, max_points=chronology_max_buckets):
+        '''
+        Reduces long scatter traces of one figure to about max_points points
+        each. The points are chosen by lttb_indices for every trace and the
+        union of them is kept for all traces, so stacked traces still share
+        their x values. Other traces are returned unchanged.
+        '''
+        scatters = [t for t in traces if t['type'] in ('scatter', 'scattergl')
+                    and t['y'] is not None and len(t['y']) > max_points]
+        if len(scatters) == 0 or len(set(len(t['y']) for t in scatters)) > 1:
+            return traces
+        n_out = max(max_points // len(scatters), 3)
+        indices = np.unique(np.concatenate(
+            [self.lttb_indices(t['y'], n_out) for t in scatters]))
+        for trace in scatters:
+            trace['x'] = np.asarray(trace['x'])[indices]
+            trace['y'] = np.asarray(trace['y'])[indices]
+        return traces
+    
+    
+    def calc_weekday_hour_counts(self):
+        '''
+        Number of messages per participant, weekday and hour of the day,
+        as reduction of calc_aggregate_cube.
+        
+        Returns: Array of shape (participants, 7, 24), weekdays start on 
+        monday and participants are ordered like self.names
+        '''
+        if 'weekday_hour_counts' in self._cache:
+            return self._cache['weekday_hour_counts']
+        
+        counts = self.calc_aggregate_cube().reduce(
+            'messages', ('participant', 'weekday', 'hour'))
+        self._cache['weekday_hour_counts'] = counts
+        return counts
+    
+    
+    def calc_time_of_day_counts(self, min_step=60):
+        '''
+        Number of messages per participant in every min_step minutes slot
+        of the day. For hourly slots this is a projection of 
+        calc_weekday_hour_counts.
+        
+        Returns: Array of shape (participants, slots)
+        '''
+        if min_step == 60:
+            return self.calc_weekday_hour_counts().sum(axis=1)
+        
+        seconds = self.df['Timestamp'].values.astype('datetime64[s]')
+        minute = (seconds.astype('int64') // 60) % (24 * 60)
+        n_slots = -(-24 * 60 // min_step)
+        n_names = len(self.names)
+        key = self.calc_writer_codes() * n_slots + minute // min_step
+        counts = np.bincount(key, minlength=n_names * n_slots)
+        return counts.reshape(n_names, n_slots)
+    
+    
+    def calc_search_index(self):
+        '''
+        Inverted index of all messages (see search_index.Chat_Index). The 
+        index is saved next to the chat file and loaded from there as long 
+        as it is newer than the chat and matches the number of messages.
+        '''
+        if 'search_index' in self._cache:
+            return self._cache['search_index']
+        
+        index = None
+        index_path = None
+        if self.path is not None and os.path.exists(self.path) and \
+                self.sample_fraction == 1:
+            index_path = Chat_Index.path_for(self.path)
+            if os.path.exists(index_path) and \
+                    os.path.getmtime(index_path) >= os.path.getmtime(self.path):
+                index = Chat_Index.load(index_path)
+                if index.n_messages != self.df.shape[0]:
+                    index = None
+        if index is None:
+            df = self.df
+            self.require_messages('The search index', df)
+            index = Chat_Index(df['Message'])
+            if index_path is not None:
+                try:
+                    index.save(index_path)
+                except OSError:
+                    pass
+        self._cache['search_index'] = index
+        return index
+    
+    
+    def calc_term_frequencies(self, term):
+        '''
+        Number of messages of every participant which contain term. 
+        
+        Returns: Series indexed by self.names
+        '''
+        ids = self.calc_search_index().search(term)
+        counts = np.bincount(self.calc_writer_codes()[ids], 
+                             minlength=len(self.names))
+        return pd.Series(counts, index=self.names)
+    
+    
+    def calc_term_usage(self, term, resolution='auto'):
+        '''
+        Number of messages per participant which contain term, aggregated 
+        like calc_chronology.
+        '''
+        ids = self.calc_search_index().search(term)
+        days = self.calc_daily_counts()['Days']
+        day_index = self.df['Timestamp'].values[ids].astype('datetime64[D]')
+        day_index = (day_index - days[0]).astype('int64')
+        n_names = len(self.names)
+        counts = np.bincount(self.calc_writer_codes()[ids] * len(days) + 
+                             day_index, minlength=n_names * len(days))
+        counts = counts.reshape(n_names, len(days))
+        return self.bucket_daily_counts(days, counts, resolution)
+    
+    
+    def calc_wordcloud(self, who='all', size=wordcloud_size):
+        '''
+        The generated WordCloud of all messages or of the messages of one
+        participant. Use .to_image() or .to_file() of it to render it.
+        
+        Args:
+        - who: "all" for the whole chat or the name of a participant
+        - size: Width and height of the wordcloud in pixels
+        '''
+        key = ('wordcloud', who, size)
+        if key in self._cache:
+            return self._cache[key]
+        # See reduce_to_aggregates, token_counts is set before the message
+        # texts are dropped
+        df = self.df
+        token_counts = self.token_counts
+        if 'Message' not in df.columns and token_counts is None:
+            self.require_messages('The wordcloud', df)
+        if who != 'all' and who not in self.names:
+            raise ValueError('The name you entered does not occur in the '
+                             'chat. Check .names attribute to see all '
+                             'possible names')
+                
+        stopwords = get_stop_words(self.languages[0])
+        if len(self.languages) > 1:
+            for i in range(1, len(self.languages)):
+                stopwords.extend(get_stop_words(self.languages[i]))
+        if self.theme == 'dark':
+            background = 'black'
+        elif self.theme == 'light':
+            background = 'white'
+        wc = WordCloud(stopwords=stopwords, width=size, height=size,
+                       max_words=400, scale=1, background_color=background)
+        if 'Message' in df.columns:
+            if who == 'all':
+                messages = df['Message']
+            else:
+                messages = df.loc[df['Written_by'] == who, 'Message']
+            wc.generate(' '.join(messages).lower())
+        else:
+            # Only the word counts are left in aggregates_only mode
+            counts = Counter()
+            for name in (self.names if who == 'all' else [who]):
+                counts.update(token_counts[name])
+            stopwords = set(stopwords)
+            wc.generate_from_frequencies(
+                {word: n for word, n in counts.items() 
+                 if word not in stopwords})
+        self._cache[key] = wc
+        return wc
+    
+    
+    def calc_message_lengths(self):
+        '''
+        Number of words and characters of every message in self.df.
+        
+        Returns: Tuple of two int64 arrays
+        '''
+        df = self.df
+        if 'Words' in df.columns:
+            return (df['Words'].values.astype('int64'), 
+                    df['Chars'].values.astype('int64'))
+        if 'message_lengths' not in self._cache:
+            messages = df['Message']
+            words = messages.str.count(' ').values.astype('int64') + 1
+            chars = messages.str.len().values.astype('int64')
+            self._cache['message_lengths'] = (words, chars)
+        return self._cache['message_lengths']
+    
+    
     def calc_message_sizes(self):
+        words, chars = self.calc_message_lengths()
+        codes = self.calc_writer_codes()
         worddict = {}
         chardict = {}
-        for table in self.tables:
-            name = table['Written_by'].iloc[0]
-            wordlens = pd.Series([len(m.split(' ')) for m in table['Message']])
-            charlens = pd.Series([len(m) for m in table['Message']])
-            worddict[name] = wordlens
-            chardict[name] = charlens
+        for i, name in enumerate(self.names):
+            worddict[name] = pd.Series(words[codes == i])
+            chardict[name] = pd.Series(chars[codes == i])
         return {'Wordlengths': worddict, 'Charlengths': chardict}
   
     def calc_respond_time(self):
+        replies = self.calc_replies()
+        intraday = replies.loc[replies['Intraday'], :]
         diffs = {}
         diffs_intraday = {}
         for name in self.names:
             diffs[name] = list()
             diffs_intraday[name] = list()
-        
-        for i in range(1, self.df.shape[0]):
-            
-            now = self.df['Timestamp'].iloc[i]
-            last = self.df['Timestamp'].iloc[i - 1]
-            now_pers = self.df['Written_by'].iloc[i]
-            last_pers = self.df['Written_by'].iloc[i - 1]
-            diff = now - last
-            
-            if (now_pers != last_pers): # so its considered to be a response
-                diffs[now_pers].append(diff.total_seconds()/60)
-                if (now.date() == last.date()): 
-                    diffs_intraday[now_pers].append(diff.total_seconds()/60)
+        for name, minutes in replies.groupby('Replier')['Minutes']:
+            diffs[name] = minutes.tolist()
+        for name, minutes in intraday.groupby('Replier')['Minutes']:
+            diffs_intraday[name] = minutes.tolist()
         
         return {'All_messages': diffs, 'Only_intraday': diffs_intraday}
+    
+    
+    def calc_replies(self):
+        '''
+        Every message whose writer differs from the writer of the message 
+        before is considered to be a reply to that previous writer. 
+        
+        Returns: DataFrame with one row per reply and the columns
+            - Replier: Name of the person who replied
+            - Replied_to: Name of the person who wrote the previous message
+            - Minutes: Time between the two messages in minutes
+            - Intraday: Whether both messages were sent on the same day
+        '''
+        if 'replies' in self._cache:
+            return self._cache['replies']
+        
+        stamps = self.df['Timestamp'].values
+        minutes = stamps.astype('datetime64[s]').astype('int64') / 60
+        days = stamps.astype('datetime64[D]')
+        codes = self.calc_writer_codes()
+        
+        is_reply = codes[1:] != codes[:-1]
+        names = np.array(self.names)
+        replies = pd.DataFrame({
+            'Replier': pd.Categorical.from_codes(codes[1:][is_reply], names),
+            'Replied_to': pd.Categorical.from_codes(codes[:-1][is_reply], 
+                                                    names),
+            'Minutes': np.diff(minutes)[is_reply],
+            'Intraday': (days[1:] == days[:-1])[is_reply]})
+        self._cache['replies'] = replies
+        return replies
+    
+    
+    def calc_reply_pairs(self):
+        '''
+        Aggregates the replies of calc_replies per (Replier, Replied_to) 
+        pair. Only pairs which occur in the chat are kept, so the result 
+        grows with the number of messages and not with the square of the 
+        number of participants.
+        
+        Returns: DataFrame with the columns Replier, Replied_to, 
+        Number_replies and Median_reply_time (minutes), sorted by 
+        Number_replies in descending order.
+        '''
+        if 'reply_pairs' in self._cache:
+            return self._cache['reply_pairs']
+        
+        replies = self.calc_replies()
+        grouped = replies.groupby(['Replier', 'Replied_to'], 
+                                  observed=True)['Minutes']
+        pairs = pd.DataFrame({'Number_replies': grouped.size(),
+                              'Median_reply_time': grouped.median()})
+        pairs = pairs.reset_index()
+        pairs = pairs.sort_values('Number_replies', ascending=False, 
+                                  kind='mergesort')
+        pairs.reset_index(drop=True, inplace=True)
+        self._cache['reply_pairs'] = pairs
+        return pairs
+    
+    
+    def calc_interaction_matrix(self, top=None):
+        '''
+        Who-replies-to-whom matrices, with the replier in the rows and the
+        person replied to in the columns. Both matrices are dense 
+        DataFrames filled from the sparse result of calc_reply_pairs.
+        
+        Args:
+        - top: If given, only the top participants (by replies sent and 
+          received) are kept, ordered by their number of replies. The 
+          matrices then have top x top entries instead of one per pair of
+          participants, which matters in large groups.
+        
+        Returns: dict with
+            - Counts: Number of replies
+            - Median_reply_time: Median reply time in minutes, NaN where
+              no reply occurred
+        '''
+        pairs = self.calc_reply_pairs()
+        n_names = len(self.names)
+        rows = pairs['Replier'].cat.codes.values.astype('int64')
+        cols = pairs['Replied_to'].cat.codes.values.astype('int64')
+        number = pairs['Number_replies'].values
+        
+        if top is None:
+            shown = np.arange(n_names)
+        else:
+            activity = np.bincount(rows, weights=number, minlength=n_names) \
+                + np.bincount(cols, weights=number, minlength=n_names)
+            shown = np.argsort(-activity, kind='mergesort')[:top]
+        # Position of every participant in the matrices, -1 if not shown
+        position = np.full(n_names, -1, dtype='int64')
+        position[shown] = np.arange(len(shown))
+        keep = (position[rows] >= 0) & (position[cols] >= 0)
+        rows = position[rows[keep]]
+        cols = position[cols[keep]]
+        
+        counts = np.zeros((len(shown), len(shown)), dtype='int64')
+        counts[rows, cols] = number[keep]
+        medians = np.full((len(shown), len(shown)), np.nan)
+        medians[rows, cols] = pairs['Median_reply_time'].values[keep]
+        
+        names = [self.names[i] for i in shown]
+        return {'Counts': pd.DataFrame(counts, index=names, columns=names),
+                'Median_reply_time': pd.DataFrame(medians, index=names,
+                                                  columns=names)}
+    
+    
+    def calc_top_reply_pairs(self, n=20, mutual=False):
+        '''
+        The n most frequent who-replies-to-whom pairs. 
+        
+        Args:
+        - n: Number of pairs to return
+        - mutual: If True, A -> B and B -> A are counted as one pair. The 
+          median reply time is then the mean of both directions medians.
+        '''
+        pairs = self.calc_reply_pairs()
+        if not mutual:
+            return pairs.head(n)
+        
+        first = pairs['Replier'].astype(str)
+        second = pairs['Replied_to'].astype(str)
+        swap = first > second
+        undirected = pd.DataFrame({
+            'Person_1': np.where(swap, second, first),
+            'Person_2': np.where(swap, first, second),
+            'Number_replies': pairs['Number_replies'].values,
+            'Median_reply_time': pairs['Median_reply_time'].values})
+        undirected = undirected.groupby(['Person_1', 'Person_2']).agg(
+            {'Number_replies': 'sum', 'Median_reply_time': 'mean'})
+        undirected = undirected.sort_values('Number_replies', 
+                                            ascending=False)
+        return undirected.reset_index().head(n)
+    
+    
+    def overview_plots(self):
+        '''
+        All plots which are shown in an overview of the chat, as tuples of
+        the name of the plot method and its keyword arguments.
+        '''
+        not_working = ['plot_wordcloud', 'plot_all_possible_plots',
+                       'plot_theme', 'plot_term_usage']
+        plots = [(m, {}) for m in dir(self) 
+                 if 'plot_' in m and m not in not_working]
+        plots.append(('plot_dist_of_respondtimes', {'tail': True}))
+        return plots
+    
+    
+    def calc_overview(self, plots=None, workers=overview_workers):
+        '''
+        Traces and layouts of many plots, computed concurrently in a pool of
+        threads. First the inputs which are shared between the plots (like
+        calc_aggregate_cube or calc_replies) are computed, every one of 
+        them once and all at the same time. Then all plots are computed at
+        the same time from the cached inputs. This takes about as long as 
+        the slowest input plus the slowest plot, instead of the sum of all.
+        
+        Args:
+        - plots: List of (method name, keyword arguments) tuples, defaults
+          to overview_plots
+        - workers: Number of threads
+        
+        Returns: List of (traces, layout) tuples in the order of plots
+        '''
+        if plots is None:
+            plots = self.overview_plots()
+        self.calc_writer_codes()
+        self.calc_message_lengths()
+        shared = [self.calc_aggregate_cube, self.calc_replies, 
+                  self.calc_sessions, self.calc_emoji_counts]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(calc) for calc in shared]:
+                future.result()
+            futures = [executor.submit(getattr(self, method), 
+                                       only_trace=True, **kwargs)
+                       for method, kwargs in plots]
+            return [future.result() for future in futures]
+    
+    
+    def trace_groups(self):
+        '''
+        The groups of participants which are plotted as one trace each: 
+        the top_n most active participants on their own and all remaining 
+        ones together as "Others". 
+        
+        Returns: List of (label, list of names, color) tuples
+        '''
+        groups = list()
+        for name in self.ranking[:self.top_n]:
+            groups.append((name, [name], 
+                           self.colors[self.name_codes([name])[0]]))
+        others = self.ranking[self.top_n:]
+        if len(others) > 0:
+            groups.append(('Others (' + str(len(others)) + ')', others, 
+                           others_color))
+        return groups
+    
+    
+    def name_codes(self, names):
+        '''
+        Positions of the given names in self.names.
+        '''
+        if 'name_codes' not in self._cache:
+            self._cache['name_codes'] = {n: i for i, n in enumerate(self.names)}
+        return [self._cache['name_codes'][n] for n in names]
+    
+    
+    def table_of(self, names):
+        '''
+        All messages written by one of the given names.
+        '''
+        if len(names) == 1 and self.tables is not None:
+            return self.tables[self.name_codes(names)[0]]
+        return self.df.loc[self.df['Written_by'].isin(names), :]
+    
+    
+    def calc_writer_codes(self):
+        '''
+        Integer code of the writer of every message in self.df, where the
+        code is the position of the writer in self.names.
+        '''
+        if 'writer_codes' not in self._cache:
+            codes = pd.Categorical(self.df['Written_by'], 
+                                   categories=self.names).codes
+            self._cache['writer_codes'] = codes.astype('int64')
+        return self._cache['writer_codes']
+    
+    
+    def calc_sessions(self, gap_minutes=session_gap_minutes):
+        '''
+        Splits the chat into conversation sessions. A new session starts 
+        whenever nobody has written for more than gap_minutes. Everything 
+        is computed on the timestamp and writer arrays at once, so this runs 
+        in linear time in the number of messages. Results are cached per 
+        gap_minutes.
+        
+        Returns: dict with
+            - Sessions: DataFrame with one row per session and the columns
+              Start, End, Duration (minutes), Number_messages, Started_by,
+              Ended_by
+            - Started: Series, number of sessions started per participant
+            - Ended: Series, number of sessions ended per participant
+            - Participated: Series, number of sessions a participant has
+              written at least one message in
+            - Share_started: Series, fraction of all sessions started by
+              each participant
+        '''
+        key = ('sessions', gap_minutes)
+        if key in self._cache:
+            return self._cache[key]
+        
+        stamps = self.df['Timestamp'].values
+        seconds = stamps.astype('datetime64[s]').astype('int64')
+        codes = self.calc_writer_codes()
+        n_names = len(self.names)
+        
+        is_start = np.empty(len(seconds), dtype=bool)
+        is_start[:1] = True
+        is_start[1:] = np.diff(seconds) > gap_minutes * 60
+        session_ids = np.cumsum(is_start) - 1
+        starts = np.flatnonzero(is_start)
+        ends = np.append(starts[1:] - 1, len(seconds) - 1)
+        
+        sessions = pd.DataFrame({
+            'Start': stamps[starts],
+            'End': stamps[ends],
+            'Duration': (seconds[ends] - seconds[starts]) / 60,
+            'Number_messages': ends - starts + 1,
+            'Started_by': np.array(self.names)[codes[starts]],
+            'Ended_by': np.array(self.names)[codes[ends]]})
+        
+        # Every (session, writer) pair is encoded as one integer, so the 
+        # distinct pairs can be found with a hash based unique
+        pairs = pd.unique(session_ids * n_names + codes)
+        participated = np.bincount(pairs % n_names, minlength=n_names)
+        started = np.bincount(codes[starts], minlength=n_names)
+        ended = np.bincount(codes[ends], minlength=n_names)
+        
+        result = {
+            'Sessions': sessions,
+            'Started': pd.Series(started, index=self.names),
+            'Ended': pd.Series(ended, index=self.names),
+            'Participated': pd.Series(participated, index=self.names),
+            'Share_started': pd.Series(started / max(len(starts), 1),
+                                       index=self.names)}
+        self._cache[key] = result
+        return result
      
     
     def meanround(self, x):
@@ -649,6 +1787,39 @@ class Whatsapp_Analytics():
         return x[x >= 0]
               
     
+    def calc_emoji_counts(self):
+        '''
+        Number of times every emoji was used by every participant.
+        
+        Returns: DataFrame with one row per emoji (sorted by total usage) 
+        and one column per participant
+        '''
+        # See reduce_to_aggregates, emoji_counts is set before the message 
+        # texts are dropped
+        df = self.df
+        if self.emoji_counts is not None:
+            return self.emoji_counts
+        if 'emoji_counts' in self._cache:
+            return self._cache['emoji_counts']
+        
+        emojis = list()
+        codes = list()
+        for code, message in zip(self.calc_writer_codes(), 
+                                 df['Message'].values):
+            found = self.extract_emojis([message])
+            emojis.extend(found)
+            codes.extend([code] * len(found))
+        counts = pd.crosstab(pd.Series(emojis, name='Emoji'),
+                             pd.Categorical.from_codes(
+                                 np.array(codes, dtype='int64'), self.names))
+        counts = counts.reindex(columns=self.names, fill_value=0)
+        counts.columns.name = None
+        counts = counts.loc[counts.sum(axis=1).sort_values(
+            ascending=False, kind='mergesort').index]
+        self._cache['emoji_counts'] = counts
+        return counts
+    
+    
     def extract_emojis(self, messages):
         emojis_all = list()
         for message in messages:
@@ -670,19 +1841,192 @@ class Whatsapp_Analytics():
     # ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~#
     ########################################################################
         
+    def search(self, query, phrase=False, who=None):
+        '''
+        Full text search over all messages. 
+        
+        Args:
+        - query: One or more words. A message matches if it contains all 
+          of them (case insensitive).
+        - phrase: If True, the words have to occur in exactly this order.
+        - who: Optional name to only search the messages of one person.
+        
+        Returns: The matching rows of self.df
+        '''
+        df = self.df
+        # A saved index can be loaded without the messages, but the found
+        # messages couldn't be shown
+        self.require_messages('The search', df)
+        index = self.calc_search_index()
+        if phrase:
+            ids = index.search_phrase(query, df['Message'].values)
+        else:
+            ids = index.search(query)
+        if who is not None:
+            code = self.name_codes([who])[0]
+            ids = ids[self.calc_writer_codes()[ids] == code]
+        return df.iloc[ids]
+    
+    
+    def calc_preview_estimates(self):
+        '''
+        Estimates of the total number of messages, words and characters
+        per participant for a chat which was only parsed partially (see 
+        sample_fraction). The sampled chunks are treated as a cluster 
+        sample of all equally sized chunks of the file, which gives 95% 
+        error bounds from the variation between the chunks. For a fully 
+        parsed chat the exact numbers with bounds of 0 are returned.
+        
+        Returns: DataFrame with one row per participant
+        '''
+        words, chars = self.calc_message_lengths()
+        measures = {
+            'Number messages sent': np.ones(len(words)),
+            'Number words sent': words,
+            'Number characters sent': chars}
+        codes = self.calc_writer_codes()
+        n_names = len(self.names)
+        if self.sample_chunks is None:
+            chunks = np.zeros(len(codes), dtype='int64')
+        else:
+            chunks = self.sample_chunks.astype('int64')
+        n_chunks = chunks.max() + 1 if len(chunks) > 0 else 1
+        population = self.sample_population
+        
+        estimates = {}
+        for measure, values in measures.items():
+            sums = np.bincount(chunks * n_names + codes, weights=values,
+                               minlength=n_chunks * n_names)
+            sums = sums.reshape(n_chunks, n_names)
+            estimates[measure] = population * sums.mean(axis=0)
+            if n_chunks > 1:
+                variance = (1 - n_chunks / population) * \
+                    sums.var(axis=0, ddof=1) / n_chunks
+                bound = 1.96 * population * np.sqrt(variance)
+            else:
+                bound = np.zeros(n_names)
+            estimates[measure + ' (95% error bound)'] = bound
+        return pd.DataFrame(estimates, index=self.names)
+    
+    
+    def memory_usage(self, seen=None):
+        '''
+        Bytes held by the chat: self.df, the per participant tables, the 
+        aggregates of aggregates_only mode and every cached result which is
+        in memory (spilled ones are not counted). The tables share the 
+        message strings with self.df, so only their own arrays are counted.
+        Temporary copies made while plotting are not included.
+        
+        Args:
+        - seen: Set of the ids of the parts which are already counted, for 
+            example by another chat sharing self.df. Such parts count as 0 
+            bytes, the ids of the other parts are added.
+        
+        Returns: pd.Series of bytes per part, cached results are named 
+            "cache: <key>"
+        '''
+        if seen is None:
+            seen = set()
+        parts = [('df', self.df, 
+                  lambda df: int(df.memory_usage(deep=True).sum())),
+                 ('tables', self.tables, 
+                  lambda tables: int(sum(t.memory_usage(deep=False).sum() 
+                                         for t in tables))),
+                 ('emoji_counts', self.emoji_counts, nbytes),
+                 ('token_counts', self.token_counts, nbytes)]
+        usage = dict()
+        for name, part, size in parts:
+            if part is None or id(part) in seen:
+                usage[name] = 0
+                continue
+            seen.add(id(part))
+            # Every part is measured once, the memo keeps the part itself
+            # so a replaced part is never taken for the old one
+            memo = self._part_bytes.get(name)
+            if memo is None or memo[0] is not part:
+                memo = (part, size(part))
+                self._part_bytes[name] = memo
+            usage[name] = memo[1]
+        for key, size in self._cache.memory_usage().items():
+            usage['cache: ' + str(key)] = size
+        return pd.Series(usage)
+    
+    
+    def reduce_memory(self, stage):
+        '''
+        Frees memory by one of the memory_stages, each one costing more 
+        than the one before:
+        - "drop_tables": Frees the per participant tables (drop_tables)
+        - "spill_cache": Writes the cached results to disk, they are read 
+            back when they are used again
+        - "aggregates_only": Drops the message texts but keeps the word 
+            frequencies for wordclouds (reduce_to_aggregates). The search 
+            and the term usage aren't available anymore afterwards.
+        
+        memory_stage counts the stages which were applied. A stage is 
+        applied only once, results which are spilled and used again stay 
+        in memory afterwards instead of being written to disk over and 
+        over.
+        
+        Returns: Number of bytes freed
+        '''
+        if stage not in self.memory_stages:
+            raise ValueError('stage has to be one of ' + 
+                             ', '.join(self.memory_stages))
+        level = self.memory_stages.index(stage) + 1
+        if self.memory_stage >= level:
+            return 0
+        before = self.memory_usage().sum()
+        if stage == 'drop_tables':
+            self.drop_tables()
+        elif stage == 'spill_cache':
+            self._cache.spill()
+        elif stage == 'aggregates_only':
+            self.reduce_to_aggregates(token_frequencies=True)
+        self.memory_stage = level
+        return before - self.memory_usage().sum()
+    
+    
+    def fit_memory(self, budget):
+        '''
+        Applies the memory_stages in order until the chat needs at most 
+        budget bytes (see memory_usage) or all stages are applied.
+        
+        Returns: The bytes used afterwards
+        '''
+        used = self.memory_usage().sum()
+        for stage in self.memory_stages[self.memory_stage:]:
+            if used <= budget:
+                break
+            used -= self.reduce_memory(stage)
+        return used
+    
+    
     def show_summary_statistics(self):
         message_sizes = self.calc_message_sizes()
         resptimes = self.calc_respond_time()
         num_messages = self.calc_number_messages_per_day()
+        sessions = self.calc_sessions()
+        cube = self.calc_aggregate_cube()
+        totals = {measure: dict(zip(self.names, 
+                                    cube.reduce(measure, ('participant',))))
+                  for measure in cube.measures}
+        if self.sample_fraction < 1:
+            estimates = self.calc_preview_estimates()
 
         summaries = list()
-        for name, table in zip(self.names, self.tables):
+        for name in self.names:
             stats = {}
-            stats['Number messages sent'] = table.shape[0]
-            total_number_words = message_sizes['Wordlengths'][name].sum()
-            total_number_chars = message_sizes['Charlengths'][name].sum()
+            stats['Number messages sent'] = totals['messages'][name]
+            total_number_words = totals['words'][name]
+            total_number_chars = totals['chars'][name]
             stats['Number words sent'] = total_number_words
             stats['Number characters sent'] = total_number_chars
+            if self.sample_fraction < 1:
+                # Only a part of the chat was parsed, so the totals are 
+                # extrapolated
+                for key, value in estimates.loc[name, :].items():
+                    stats[key] = np.round(value, decimals=3)
             av_messages = self.meanround(num_messages[name])
             max_messages = self.maxround(num_messages[name])
             stats['Average number of messages per day'] = av_messages
@@ -695,6 +2039,12 @@ class Whatsapp_Analytics():
             av_resp_id = self.meanround(resptimes['Only_intraday'][name])
             stats['Average respond time for all messages (minutes)'] = av_resp_all
             stats['Average respond time for intraday messages (minutes)'] = av_resp_id
+            stats['Number of conversations started'] = sessions['Started'][name]
+            stats['Number of conversations ended'] = sessions['Ended'][name]
+            stats['Number of conversations participated in'] = \
+                sessions['Participated'][name]
+            stats['Percentage of conversations started'] = \
+                np.round(100 * sessions['Share_started'][name], decimals=3)
             series = pd.Series(np.fromiter(stats.values(), dtype='float64'))
             series.index = stats.keys()
             summaries.append(series)
@@ -704,3 +2054,65 @@ class Whatsapp_Analytics():
         
         return restable
     
+    
+    
+    def calc_aggregates(self, kind):
+        '''
+        Numbers behind the plots as plain python objects which can be 
+        serialized to JSON. Per participant values are lists ordered like 
+        the "names" entry.
+        
+        Args:
+        - kind: One of
+            - "summary": show_summary_statistics as {statistic: values}
+            - "daily": Number of messages per day from "first_day" on
+            - "hours": Number of messages per hour of the day
+            - "weekdays": Number of messages per weekday (Monday first)
+            - "emojis": The max_emojis most used emojis and their counts
+            - "respond_times": Number of replies in the respond_time_bins 
+              (minutes, the last bin is open ended)
+        
+        Raises:
+        ValueError: When kind is none of the above
+        '''
+        def values(array):
+            # NaN is not valid JSON
+            return [None if isinstance(v, float) and np.isnan(v) else v 
+                    for v in np.asarray(array).tolist()]
+        
+        result = {'names': list(self.names)}
+        if self.sample_fraction < 1:
+            result['sample_fraction'] = self.sample_fraction
+        if kind == 'summary':
+            restable = self.show_summary_statistics()
+            result['statistics'] = {stat: values(restable.loc[stat, :]) 
+                                    for stat in restable.index}
+        elif kind == 'daily':
+            daily = self.calc_daily_counts()
+            result['first_day'] = str(daily['Days'][0])
+            result['counts'] = daily['Counts'].tolist()
+        elif kind == 'hours':
+            result['counts'] = self.calc_time_of_day_counts().tolist()
+        elif kind == 'weekdays':
+            result['weekdays'] = self.weekdays
+            result['counts'] = \
+                self.calc_weekday_hour_counts().sum(axis=2).tolist()
+        elif kind == 'emojis':
+            counts = self.calc_emoji_counts().iloc[:max_emojis]
+            result['emojis'] = counts.index.tolist()
+            result['counts'] = counts.values.T.tolist()
+        elif kind == 'respond_times':
+            replies = self.calc_replies()
+            edges = np.append(respond_time_bins, np.inf)
+            codes = replies['Replier'].cat.codes.values.astype('int64')
+            bins = np.digitize(replies['Minutes'].values, edges) - 1
+            # Messages which are not in chronological order count as 0
+            bins = np.clip(bins, 0, len(respond_time_bins) - 1)
+            n_bins = len(respond_time_bins)
+            counts = np.bincount(codes * n_bins + bins, 
+                                 minlength=len(self.names) * n_bins)
+            result['bins'] = list(respond_time_bins)
+            result['counts'] = counts.reshape(-1, n_bins).tolist()
+        else:
+            raise ValueError('Unknown kind of aggregates: ' + str(kind))
+        return result
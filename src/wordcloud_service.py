@@ -0,0 +1,161 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import wordcloud_size, wordcloud_workers
+from config import wordcloud_cache_directory, wordcloud_cache_files
+
+
+class Wordcloud_Service():
+    '''
+    Renders wordclouds of chats as png files in a pool of worker threads and
+    caches them on disk. A file is identified by a hash of the chat (its
+    path together with size and modification time of the file, or the
+    parsed messages for uploaded chats), whether it is a preview, the 
+    participant, the languages, the theme and the size, so the same 
+    wordcloud is never rendered twice.
+    When more than max_files are cached, the least recently used ones are
+    deleted. A wordcloud which can't be rendered (like the one of a 
+    participant who only sent emojis) is not tried again, get raises its
+    error instead.
+
+    Args of __init__:
+    - directory: Directory of the cached png files
+    - max_files: Maximum number of cached png files
+    - workers: Number of wordclouds which are rendered at the same time
+    '''
+
+    def __init__(self, directory=wordcloud_cache_directory,
+                 max_files=wordcloud_cache_files, workers=wordcloud_workers):
+        self.directory = directory
+        self.max_files = max_files
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = {}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+
+    @staticmethod
+    def chat_identity(wa):
+        if os.path.exists(wa.path):
+            stat = os.stat(wa.path)
+            return [os.path.abspath(wa.path), stat.st_size, stat.st_mtime,
+                    wa.exclude]
+        # Uploaded chats have no file, their content is described by the
+        # number and the time range of their messages
+        return [wa.path, len(wa.df), str(wa.df['Timestamp'].min()),
+                str(wa.df['Timestamp'].max()), wa.exclude]
+
+
+    def make_key(self, wa, who='all', size=wordcloud_size):
+        # Previews and chats without message texts (drawn from the word 
+        # frequencies) give other wordclouds than the full chat
+        identity = self.chat_identity(wa) + [who, wa.languages, wa.theme,
+                                             size, wa.sample_fraction,
+                                             wa.aggregates_only]
+        return hashlib.sha1(repr(identity).encode('utf-8')).hexdigest()
+
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+
+    def render(self, wa, who, size, key):
+        path = self.path_for(key)
+        temporary = path + '.' + str(threading.get_ident()) + '.tmp'
+        try:
+            image = wa.calc_wordcloud(who, size).to_image()
+            image.save(temporary, format='png', optimize=True)
+            # Renaming is atomic, so readers never see a half written file
+            os.replace(temporary, path)
+            self.evict()
+            return path
+        except Exception as error:
+            with self.lock:
+                self.failed[key] = error
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+
+    def submit(self, wa, who='all', size=wordcloud_size):
+        '''
+        Starts rendering a wordcloud unless it is cached, already being
+        rendered or failed before.
+
+        Returns: The key of the wordcloud
+        '''
+        key = self.make_key(wa, who, size)
+        with self.lock:
+            if key in self.pending or key in self.failed or \
+                    os.path.exists(self.path_for(key)):
+                return key
+            self.pending[key] = (wa.path, self.executor.submit(
+                self.render, wa, who, size, key))
+        return key
+
+
+    def prerender(self, wa, size=wordcloud_size):
+        '''
+        Starts rendering the wordcloud of the whole chat and of its most
+        active participants. Previews of chats are skipped, since their
+        wordclouds would be incomplete.
+        '''
+        if wa.sample_fraction < 1:
+            return
+        for who in ['all'] + wa.ranking[:wa.top_n]:
+            self.submit(wa, who, size)
+
+
+    def get(self, wa, who='all', size=wordcloud_size, wait=False):
+        '''
+        The path of the rendered wordcloud. If it isn't rendered yet, the
+        rendering is started and None returned, or with wait the rendering
+        is awaited.
+
+        Raises:
+        The error of the rendering, if it failed
+        '''
+        key = self.submit(wa, who, size)
+        with self.lock:
+            error = self.failed.get(key)
+        if error is not None:
+            raise error
+        path = self.path_for(key)
+        if os.path.exists(path):
+            # Mark the file as recently used for the eviction
+            os.utime(path, None)
+            return path
+        if not wait:
+            return None
+        with self.lock:
+            pending = self.pending.get(key)
+        if pending is not None:
+            return pending[1].result()
+        return path if os.path.exists(path) else None
+
+
+    def is_rendering(self, path):
+        '''
+        Whether a wordcloud of the chat at path is currently rendered.
+        '''
+        with self.lock:
+            return any(p == path for p, _ in self.pending.values())
+
+
+    def evict(self):
+        files = [os.path.join(self.directory, f)
+                 for f in os.listdir(self.directory) if f.endswith('.png')]
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=lambda f: os.path.getmtime(f))
+        for file in files[:len(files) - self.max_files]:
+            try:
+                os.remove(file)
+            except OSError:
+                pass